@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+无界面批量转写工具：从文件或标准输入读取视频链接/BV号列表，依次完成下载、切分和转写。
+模型只加载一次，供所有任务复用；下载与音频切分按 --concurrency 并发执行，转写在主进程中依次进行，
+已提交下载但尚未转写的任务不超过 2×concurrency 个，链接很多时不会提前占满磁盘。
+每个任务的状态与结果写入汇总文件，配合 --resume 可以跳过已经完成的任务，中断的任务从转写断点继续。
+
+用法:
+    python batch.py links.txt --model small --concurrency 3
+    cat links.txt | python batch.py - --resume
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils import download_video
+from exAudio import process_audio_split
+
+
+def read_links(source):
+    """读取链接列表，忽略空行、以 # 开头的注释行和重复的链接"""
+    f = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
+    try:
+        links = [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+        return list(dict.fromkeys(links))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class JobSummary:
+    """线程安全的任务汇总，每次更新后整体重写 JSON 文件"""
+
+    def __init__(self, path, links, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        previous = {}
+        if resume and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                previous = {job["link"]: job for job in json.load(f).get("jobs", [])}
+        self.jobs = [previous.get(link) or {"link": link, "status": "pending"} for link in links]
+
+    def is_done(self, job):
+        return job.get("status") == "done" and os.path.exists(job.get("output") or "")
+
+    def update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"updated": time.strftime("%Y-%m-%d %H:%M:%S"), "jobs": self.jobs}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def prepare_job(job, summary, slice_length):
+    """下载并切分音频（在线程池中执行）"""
+    if job.get("folder") and os.path.isdir(f"audio/slice/{job['folder']}"):
+        # 上次中断的任务沿用原文件夹，转写时从断点继续
+        summary.update(job, status="queued", started=time.time(), error=None)
+        return job
+    summary.update(job, status="downloading", started=time.time(), error=None)
+    file_id = download_video(job["link"])
+    if file_id is None:
+        raise RuntimeError("视频下载失败")
+    summary.update(job, status="splitting", file_id=file_id)
+    folder_name = f"{time.strftime('%Y%m%d%H%M%S')}_{file_id}"
+    process_audio_split(file_id, slice_length, folder_name=folder_name)
+    summary.update(job, status="queued", folder=folder_name)
+    return job
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bili2text 批量转写")
+    parser.add_argument("input", help="链接列表文件，每行一个视频链接或BV号；使用 - 从标准输入读取")
+    parser.add_argument("--model", default="small", help="Whisper 模型名称（默认 small）")
+    parser.add_argument("--concurrency", type=int, default=2, help="同时进行的下载/切分任务数（默认 2）")
+    parser.add_argument("--prompt", default="以下是普通话的句子。这是一个关于{id}的视频。", help="转写提示词，{id} 会替换为视频标识")
+    parser.add_argument("--summary", default="outputs/batch_summary.json", help="任务状态汇总文件")
+    parser.add_argument("--resume", action="store_true", help="跳过汇总文件中已完成的任务，中断的任务从断点继续")
+    args = parser.parse_args()
+
+    links = read_links(args.input)
+    if not links:
+        print("没有需要处理的链接。")
+        return 0
+    summary = JobSummary(args.summary, links, resume=args.resume)
+    todo = [job for job in summary.jobs if not (args.resume and summary.is_done(job))]
+    print(f"共 {len(summary.jobs)} 个任务，待处理 {len(todo)} 个")
+    if not todo:
+        return 0
+
+    import speech2text
+    speech2text.load_whisper(model=args.model)
+    slice_length = speech2text.preferred_slice_length()
+
+    failed = 0
+    concurrency = max(1, args.concurrency)
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    remaining = iter(todo)
+    futures = {}
+
+    def submit_more():
+        # 正在下载切分的任务加上已就绪、等待转写的任务不超过 2×concurrency 个
+        for job in itertools.islice(remaining, 2 * concurrency - len(futures)):
+            futures[pool.submit(prepare_job, job, summary, slice_length)] = job
+
+    try:
+        submit_more()
+        while futures:
+            # 谁先下载切分完成就先转写，保证模型始终有活干
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = futures.pop(future)
+                submit_more()
+                try:
+                    future.result()
+                    summary.update(job, status="transcribing")
+                    print("=" * 10)
+                    print(f"正在转写: {job['link']} ({job['folder']})")
+                    speech2text.run_analysis(job["folder"], prompt=args.prompt.format(id=job["file_id"]),
+                                             job_info={"file_id": job["file_id"], "link": job["link"]})
+                    summary.update(job, status="done", output=f"outputs/{job['folder']}.md",
+                                   finished=time.time(), duration=round(time.time() - job["started"], 1))
+                except Exception as e:
+                    failed += 1
+                    print(f"任务失败: {job['link']}: {e}")
+                    summary.update(job, status="failed", error=str(e), finished=time.time())
+    except KeyboardInterrupt:
+        print("已中断，未完成的任务可使用 --resume 继续。")
+        # 取消尚未开始的任务，不等待正在进行的下载
+        pool.shutdown(wait=False, cancel_futures=True)
+        for job in todo:
+            if job.get("status") not in ("done", "failed", "pending"):
+                summary.update(job, status="interrupted")
+        raise
+    pool.shutdown()
+
+    print(f"全部完成：成功 {len(todo) - failed} 个，失败 {failed} 个。汇总：{args.summary}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
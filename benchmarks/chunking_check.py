@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+润色分块的回归检查：用合成的中文、英文、中英混合文本调用 speech2text._split_text_into_chunks，
+检查每块的 token 数（整块重新计数）不超过预算、分块前后文本内容一致，任一检查失败时以非零状态退出。
+默认使用与润色相同的计数方式（KIMI_TOKENIZER，tiktoken 不可用时为估算），可用 --tokenizer estimate 强制估算。
+
+用法:
+    python benchmarks/chunking_check.py
+    python benchmarks/chunking_check.py --tokenizer estimate --budgets 300,2000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CJK = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经"
+_WORDS = ("the quick brown fox jumps over a lazy dog while we talk about model training data and "
+          "speech recognition pipelines in production systems at scale").split()
+
+
+def _english(rng, sentences):
+    return " ".join(" ".join(rng.choice(_WORDS) for _ in range(rng.randint(6, 25))).capitalize() + "."
+                    for _ in range(sentences))
+
+
+def _chinese(rng, sentences):
+    return "".join("".join(rng.choice(_CJK) for _ in range(rng.randint(10, 60))) + rng.choice("。！？，")
+                   for _ in range(sentences))
+
+
+def _mixed(rng, sentences):
+    return "\n".join(_english(rng, 1) if rng.random() < 0.5 else _chinese(rng, 1) for _ in range(sentences))
+
+
+def _no_punctuation(rng, sentences):
+    return " ".join(rng.choice(_WORDS) for _ in range(sentences * 15))
+
+
+TEXTS = [
+    ("英文", _english),
+    ("中文", _chinese),
+    ("中英混合", _mixed),
+    ("无标点", _no_punctuation),
+]
+
+
+def check(speech2text, name, text, budget):
+    chunks = speech2text._split_text_into_chunks(text, budget)
+    counts = speech2text._count_tokens_batch(chunks)
+    over = [c for c in counts if c > budget]
+    same = re.sub(r"\s+", "", "".join(chunks)) == re.sub(r"\s+", "", text)
+    ok = not over and same and len(chunks) > 0
+    total = speech2text._count_tokens(text)
+    detail = (f"{len(chunks)} 块，最大 {max(counts)} / 预算 {budget}，平均填充 {total / len(chunks) / budget:.0%}"
+              + ("" if same else "，文本内容不一致"))
+    return ok, detail
+
+
+def main():
+    parser = argparse.ArgumentParser(description="润色分块回归检查")
+    parser.add_argument("--tokenizer", help="覆盖 KIMI_TOKENIZER，例如 estimate 或 cl100k_base")
+    parser.add_argument("--budgets", default="300,2000", help="每块的 token 预算（逗号分隔）")
+    parser.add_argument("--sentences", type=int, default=400, help="每段合成文本的句子数")
+    args = parser.parse_args()
+    if args.tokenizer:
+        os.environ["KIMI_TOKENIZER"] = args.tokenizer
+    sys.path.insert(0, ROOT)
+    import speech2text
+
+    rng = random.Random(0)
+    failed = 0
+    for name, make in TEXTS:
+        text = make(rng, args.sentences)
+        for budget in [int(b) for b in args.budgets.split(",") if b.strip()]:
+            ok, detail = check(speech2text, name, text, budget)
+            failed += not ok
+            print(f"{name:<8}{budget:>6}  {'通过' if ok else '失败'}  {detail}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+启动耗时基准：在全新的解释器中执行各类命令的启动步骤，测量导入耗时，
+并检查是否提前导入了与该命令无关的重量级依赖（torch/whisper/openai/moviepy/pydub 等）。
+任一场景导入了禁止的模块或超过耗时预算时以非零状态退出，可以作为发布前的检查。
+
+用法:
+    python benchmarks/import_time.py                # 默认预算 1 秒（refine-only 为 1.5 秒），每个场景取 3 次的中位数
+    python benchmarks/import_time.py --budget 0.5 --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY = ("torch", "whisper", "openai", "moviepy", "pydub", "tiktoken")
+
+DEFAULT_BUDGET = 1.0
+
+# (名称, 启动代码, 额外环境变量, 禁止导入的模块, 耗时预算)
+# refine-only 必须导入 openai SDK 来创建 Kimi 客户端，单独导入 openai 就要 0.6~0.8 秒，
+# speech2text 自身约 0.1 秒，实测中位数 0.85~1.06 秒，因此单独给 1.5 秒
+SCENARIOS = [
+    ("download-only", "import utils", {}, HEAVY, DEFAULT_BUDGET),
+    ("cli-startup", "import main", {}, HEAVY, DEFAULT_BUDGET),
+    ("gui-client", "import daemon, pipeline, batch", {}, HEAVY, DEFAULT_BUDGET),
+    ("refine-only", "import speech2text; speech2text._get_kimi_client()",
+     {"KIMI_API_KEY": "sk-benchmark"}, ("torch", "whisper", "moviepy", "pydub"), 1.5),
+    ("openai-api", "import speech2text; speech2text.load_whisper('small'); speech2text._async_pool()",
+     {"OPENAI_API_KEY": "sk-benchmark", "USE_OPENAI_WHISPER": "1"}, ("torch", "whisper", "moviepy", "pydub"),
+     DEFAULT_BUDGET),
+]
+
+_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+elapsed = time.perf_counter() - start
+forbidden = json.loads(sys.argv[2])
+print("\\n" + json.dumps({"seconds": elapsed, "loaded": sorted(m for m in forbidden if m in sys.modules)}))
+"""
+
+
+def run_scenario(code, extra_env, forbidden):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""), **extra_env)
+    result = subprocess.run(
+        [sys.executable, "-c", _CHILD, code, json.dumps(forbidden)],
+        cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "子进程异常退出")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bili2text 启动耗时基准")
+    parser.add_argument("--budget", type=float, help="统一指定每个场景允许的导入耗时（秒），默认按场景各自的预算")
+    parser.add_argument("--repeat", type=int, default=3, help="每个场景运行次数，取中位数（默认 3）")
+    args = parser.parse_args()
+
+    failed = 0
+    print(f"{'场景':<16}{'耗时(s)':>10}  结果")
+    for name, code, extra_env, forbidden, budget in SCENARIOS:
+        budget = budget if args.budget is None else args.budget
+        try:
+            runs = [run_scenario(code, extra_env, forbidden) for _ in range(max(1, args.repeat))]
+        except RuntimeError as e:
+            failed += 1
+            print(f"{name:<16}{'-':>10}  出错: {e}")
+            continue
+        seconds = statistics.median(run["seconds"] for run in runs)
+        loaded = sorted({m for run in runs for m in run["loaded"]})
+        problems = []
+        if loaded:
+            problems.append("提前导入了 " + ", ".join(loaded))
+        if seconds > budget:
+            problems.append(f"超过预算 {budget:.2f}s")
+        failed += bool(problems)
+        print(f"{name:<16}{seconds:>10.3f}  {'; '.join(problems) or '通过'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
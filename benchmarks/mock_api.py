@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+本地模拟接口：在一个 HTTP 服务中同时模拟 OpenAI 转写、Kimi（OpenAI 兼容）对话和讯飞录音文件转写接口，
+用于离线基准测试与联调。每个请求按配置增加延迟，并按每分钟请求数限流（超出时返回 429 和 Retry-After）。
+
+    OpenAI:  POST /v1/audio/transcriptions
+    Kimi:    POST /v1/chat/completions
+    讯飞:    POST /v2/api/upload、POST /v2/api/getResult
+    统计:    GET  /stats
+
+用法:
+    python benchmarks/mock_api.py --port 8790 --latency 0.3 --rpm 60
+    然后设置 OPENAI_API_BASE=http://127.0.0.1:8790/v1、KIMI_API_BASE=http://127.0.0.1:8790/v1、
+    XUNFEI_HOST=http://127.0.0.1:8790/v2/api
+"""
+import argparse
+import collections
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_FAMILIES = {
+    "/audio/transcriptions": "openai",
+    "/chat/completions": "kimi",
+    "/upload": "xunfei",
+    "/getResult": "xunfei",
+}
+
+
+class MockAPIServer:
+    """
+    latency: 每个请求的固定延迟（秒），jitter 为额外的随机延迟上限。
+    rpm: 每类接口每分钟允许的请求数，0 表示不限制。
+    xunfei_rtf: 讯飞订单的模拟处理耗时与音频时长之比。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, rpm=0, xunfei_rtf=0.01):
+        self.latency = latency
+        self.jitter = jitter
+        self.rpm = rpm
+        self.xunfei_rtf = xunfei_rtf
+        self.lock = threading.Lock()
+        self.history = collections.defaultdict(collections.deque)  # 接口类别 -> 最近 60 秒的请求时间
+        self.orders = {}  # orderId -> (完成时间, 文件名, 时长毫秒)
+        self.order_ids = itertools.count(1)
+        self.stats = collections.Counter()
+        self.active = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def env(self):
+        """返回把各后端指向本服务所需的环境变量"""
+        return {
+            "OPENAI_API_KEY": "sk-mock",
+            "OPENAI_API_BASE": self.url + "/v1",
+            "KIMI_API_KEY": "sk-mock",
+            "KIMI_API_BASE": self.url + "/v1",
+            "XUNFEI_APPID": "mock",
+            "XUNFEI_SECRET_KEY": "mock",
+            "XUNFEI_HOST": self.url + "/v2/api",
+        }
+
+    def _admit(self, family):
+        """按滑动窗口限流，返回需要等待的秒数；0 表示放行"""
+        if not self.rpm:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            history = self.history[family]
+            while history and now - history[0] >= 60:
+                history.popleft()
+            if len(history) >= self.rpm:
+                self.stats[family + "_429"] += 1
+                return max(60 - (now - history[0]), 0.1)
+            history.append(now)
+        return 0
+
+    def _make_handler(server):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, code, obj, headers=None):
+                body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with server.lock:
+                    stats = dict(server.stats, active=server.active)
+                self._reply(200, stats)
+
+            def do_POST(self):
+                parsed = urllib.parse.urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                family = next((f for suffix, f in _FAMILIES.items() if parsed.path.endswith(suffix)), None)
+                if family is None:
+                    self._reply(404, {"error": {"message": "not found"}})
+                    return
+                wait = server._admit(family)
+                if wait:
+                    self._reply(429, {"error": {"message": "rate limited"}}, {"Retry-After": f"{wait:.1f}"})
+                    return
+                with server.lock:
+                    server.stats[family] += 1
+                    server.active += 1
+                    server.stats["peak_active"] = max(server.stats["peak_active"], server.active)
+                try:
+                    time.sleep(server.latency + random.uniform(0, server.jitter))
+                    query = dict(urllib.parse.parse_qsl(parsed.query))
+                    if family == "openai":
+                        text = f"模拟转写结果（{len(body)} 字节）。"
+                        reply = {"text": text}
+                        if b"verbose_json" in body:
+                            reply["segments"] = [{"id": 0, "start": 0.0, "end": 1.0, "text": text}]
+                        self._reply(200, reply)
+                    elif family == "kimi":
+                        self._reply(200, server._chat_completion(json.loads(body)))
+                    elif parsed.path.endswith("/upload"):
+                        self._reply(200, server._xunfei_upload(query))
+                    else:
+                        self._reply(200, server._xunfei_result(query))
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+        return Handler
+
+    def _chat_completion(self, request):
+        # 原样返回转写原文部分，输出长度与输入相近
+        content = request["messages"][-1]["content"]
+        text = content.split("\n", 3)[-1]
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": len(content), "completion_tokens": len(text), "total_tokens": len(content) + len(text)},
+        }
+
+    def _xunfei_upload(self, query):
+        duration_ms = float(query.get("duration") or 0)
+        with self.lock:
+            order_id = f"mock{next(self.order_ids)}"
+            self.orders[order_id] = (time.monotonic() + duration_ms / 1000 * self.xunfei_rtf, query.get("fileName"), duration_ms)
+        return {"code": "000000", "content": {"orderId": order_id, "taskEstimateTime": int(duration_ms * self.xunfei_rtf)}}
+
+    def _xunfei_result(self, query):
+        with self.lock:
+            done_at, name, duration_ms = self.orders[query["orderId"]]
+        if time.monotonic() < done_at:
+            return {"code": "000000", "content": {"orderInfo": {"status": 3}}}
+        best = {"st": {"bg": "0", "ed": str(int(duration_ms)), "rt": [{"ws": [{"cw": [{"w": f"模拟转写结果（{name}）。"}]}]}]}}
+        result = {"lattice": [{"json_1best": json.dumps(best, ensure_ascii=False)}]}
+        return {"code": "000000", "content": {"orderInfo": {"status": 4}, "orderResult": json.dumps(result, ensure_ascii=False)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI / Kimi / 讯飞 本地模拟接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--latency", type=float, default=0.2, help="每个请求的固定延迟（秒，默认 0.2）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="额外随机延迟的上限（秒）")
+    parser.add_argument("--rpm", type=int, default=0, help="每类接口每分钟请求数上限，0 表示不限制")
+    parser.add_argument("--xunfei-rtf", type=float, default=0.01, help="讯飞订单处理耗时与音频时长之比（默认 0.01）")
+    args = parser.parse_args()
+    server = MockAPIServer(args.host, args.port, args.latency, args.jitter, args.rpm, args.xunfei_rtf)
+    print(f"模拟接口已启动: {server.url}")
+    for key, value in server.env().items():
+        print(f"  {key}={value}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
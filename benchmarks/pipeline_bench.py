@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+离线流水线基准：用 ffmpeg 在本地生成不同时长的合成视频（默认 30 秒、10 分钟、2 小时），
+分别测量音频提取、完整性校验、切分、转写、润色各阶段的耗时、峰值内存（RSS）和实时率（RTF = 耗时 / 音频时长）。
+每个阶段在独立的子进程中运行，峰值内存互不影响；云端接口由 benchmarks/mock_api.py 的本地模拟服务代替，
+可以配置延迟和每分钟请求数。给出 --baseline 时与上一次的 --json 结果对比，超出容差即以非零状态退出。
+完整性校验与切分应当是恒定内存的：最长与最短视频的峰值 RSS 之差超过 --rss-growth 时同样以非零状态退出。
+
+用法:
+    python benchmarks/pipeline_bench.py --lengths 30,600 --json bench.json
+    python benchmarks/pipeline_bench.py --backend xunfei --latency 0.5 --rpm 120
+    python benchmarks/pipeline_bench.py --baseline bench.json --tolerance 0.25
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from mock_api import MockAPIServer  # noqa: E402
+
+STAGES = ("extract", "integrity", "split", "transcribe", "refine")
+FLAT_MEMORY_STAGES = ("integrity", "split")  # 峰值内存不应随音频时长增长的阶段
+DEFAULT_LENGTHS = "30,600,7200"
+
+# 润色阶段的合成文稿，按每秒约 4 个汉字生成
+_SENTENCES = (
+    "今天我们来聊一聊视频转文字的整体流程。",
+    "首先需要把视频中的音轨提取出来，再按静音位置切分成小段。",
+    "每一段音频分别送去识别，最后按时间顺序拼接成完整的文稿。",
+    "识别结果里难免有错别字和断句问题，所以还要做一次润色。",
+)
+
+
+def fixture_path(fixtures_dir, seconds):
+    return os.path.join(fixtures_dir, f"bench_{seconds}s.mp4")
+
+
+def make_fixture(fixtures_dir, seconds):
+    """生成合成视频：低分辨率画面加间歇的正弦音，每 6 秒中有 1.5 秒静音，便于语音检测切分"""
+    path = fixture_path(fixtures_dir, seconds)
+    if os.path.exists(path):
+        return path
+    os.makedirs(fixtures_dir, exist_ok=True)
+    print(f"正在生成 {seconds} 秒的测试视频...")
+    part = path + ".part.mp4"
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"color=c=gray:s=160x90:r=5:d={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate=16000:duration={seconds}",
+        "-af", "volume='if(lt(mod(t,6),4.5),0.5,0)':eval=frame",
+        "-c:a", "aac", "-b:a", "64k", "-shortest", part,
+    ], check=True)
+    os.replace(part, path)
+    return path
+
+
+def synthetic_text(seconds):
+    sentences = []
+    chars = 0
+    while chars < seconds * 4:
+        sentence = _SENTENCES[len(sentences) % len(_SENTENCES)]
+        sentences.append(sentence)
+        chars += len(sentence)
+    return "".join(sentences)
+
+
+def peak_rss_mb():
+    """返回 (本进程峰值 RSS, 子进程峰值 RSS)，单位 MB；不支持 resource 模块的平台返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    scale = 1 if sys.platform == "darwin" else 1024  # macOS 以字节为单位，Linux 以 KB 为单位
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2 ** 20
+    return own, children
+
+
+def run_stage(stage, fixture, backend, model):
+    """在子进程中执行单个阶段（工作目录已切换到临时目录），返回计时结果"""
+    import exAudio
+    name = "bench"
+    os.makedirs("bilibili_video", exist_ok=True)
+    shutil.copyfile(fixture, os.path.join("bilibili_video", name + ".mp4"))
+    extra = {}
+    if stage == "extract":
+        from moviepy.editor import AudioFileClip  # noqa: F401  提前导入，不计入阶段耗时
+        start = time.perf_counter()
+        exAudio.convert_flv_to_mp3(name)
+    elif stage == "integrity":
+        start = time.perf_counter()
+        extra["ok"] = exAudio.check_video_integrity(os.path.join("bilibili_video", name + ".mp4"))
+    elif stage == "split":
+        # 文件模式的流式切分（process_audio_memory 需要在内存中保留全部切片，其内存占用计入转写阶段）
+        start = time.perf_counter()
+        exAudio.split_mp3(os.path.join("bilibili_video", name + ".mp4"), name)
+        with open(os.path.join("audio", "slice", name, "slices.json"), encoding="utf-8") as f:
+            extra["slices"] = len(json.load(f))
+    elif stage == "transcribe":
+        _, slices = exAudio.process_audio_memory(name)
+        extra["slices"] = len(slices)
+        if backend == "xunfei":
+            import xunfei
+            start = time.perf_counter()
+            xunfei.transcribe_slices(slices)
+        else:
+            import speech2text
+            speech2text.load_whisper(model)  # 本地模型的加载耗时不计入转写阶段
+            start = time.perf_counter()
+            for _ in speech2text._iter_results(slices, "以下是普通话的句子。", speech2text.WHISPER_BATCH_SIZE):
+                pass
+    elif stage == "refine":
+        import speech2text
+        seconds = float(os.environ["B2T_BENCH_SECONDS"])
+        text = synthetic_text(seconds)
+        extra["chars"] = len(text)
+        start = time.perf_counter()
+        speech2text._refine_with_kimi(text, "以下是普通话的句子。")
+    else:
+        raise ValueError(f"未知阶段: {stage}")
+    elapsed = time.perf_counter() - start
+    own, children = peak_rss_mb()
+    return dict(extra, seconds=elapsed, rss_mb=own, children_rss_mb=children)
+
+
+def bench_stage(stage, fixture, seconds, args, mock_env):
+    """启动子进程运行一个阶段，返回结果字典；阶段依赖缺失或失败时 error 字段给出原因"""
+    workdir = tempfile.mkdtemp(prefix=f"b2t-bench-{stage}-")
+    env = dict(os.environ, **mock_env)
+    env.update({
+        "PYTHONPATH": os.path.dirname(ROOT) + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        "B2T_CACHE": "0",
+        "B2T_METRICS": "0",
+        "B2T_BENCH_SECONDS": str(seconds),
+        "USE_OPENAI_WHISPER": "1" if args.backend == "openai" else "0",
+    })
+    if args.backend != "openai":
+        env.pop("OPENAI_API_KEY", None)
+    try:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--fixture", fixture,
+             "--backend", args.backend, "--model", args.model],
+            cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            encoding="utf-8", errors="replace",
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"退出码 {proc.returncode}"
+        return {"stage": stage, "length": seconds, "error": error}
+    result = json.loads(lines[-1])
+    result.update(stage=stage, length=seconds, rtf=result["seconds"] / seconds)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """与基线逐项对比耗时和峰值内存，返回超出容差的描述列表"""
+    base = {(r["length"], r["stage"]): r for r in baseline if "error" not in r}
+    regressions = []
+    for result in results:
+        old = base.get((result["length"], result["stage"]))
+        if not old or "error" in result:
+            continue
+        for field in ("seconds", "rss_mb"):
+            if old.get(field) and result.get(field) and result[field] > old[field] * (1 + tolerance):
+                regressions.append(f"{result['length']}s/{result['stage']}: {field} {old[field]:.2f} -> {result[field]:.2f}")
+    return regressions
+
+
+def check_flat_memory(results, max_growth):
+    """恒定内存阶段：最长视频与最短视频的峰值 RSS 之差不得超过 max_growth（MB）"""
+    problems = []
+    for stage in FLAT_MEMORY_STAGES:
+        runs = sorted((r for r in results if r["stage"] == stage and r.get("rss_mb")), key=lambda r: r["length"])
+        if len(runs) < 2:
+            continue
+        growth = runs[-1]["rss_mb"] - runs[0]["rss_mb"]
+        if growth > max_growth:
+            problems.append(f"{stage}: {runs[0]['length']}s -> {runs[-1]['length']}s 峰值内存增长 {growth:.1f}MB")
+    return problems
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bili2text 离线流水线基准")
+    parser.add_argument("--lengths", default=DEFAULT_LENGTHS, help=f"测试视频时长（秒，逗号分隔，默认 {DEFAULT_LENGTHS}）")
+    parser.add_argument("--stages", default=",".join(STAGES), help="要测量的阶段（逗号分隔）")
+    parser.add_argument("--backend", choices=("openai", "xunfei", "whisper"), default="openai",
+                        help="转写阶段使用的后端：openai/xunfei 连接本地模拟接口，whisper 使用本地模型（默认 openai）")
+    parser.add_argument("--model", default="tiny", help="whisper 后端的模型名称（默认 tiny）")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟接口每个请求的延迟（秒，默认 0.2）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="模拟接口额外随机延迟的上限（秒）")
+    parser.add_argument("--rpm", type=int, default=0, help="模拟接口每分钟请求数上限，0 表示不限制")
+    parser.add_argument("--fixtures", default=os.path.join(tempfile.gettempdir(), "b2t-bench-fixtures"),
+                        help="测试视频的缓存目录")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，可作为之后的 --baseline")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的耗时/内存增长比例（默认 0.25）")
+    parser.add_argument("--rss-growth", type=float, default=64,
+                        help=f"{'/'.join(FLAT_MEMORY_STAGES)} 阶段在最长与最短视频间允许的峰值内存增长（MB，默认 64）")
+    parser.add_argument("--run-stage", help=argparse.SUPPRESS)
+    parser.add_argument("--fixture", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        # 子进程：阶段自身的输出走 stderr，最后一行 stdout 是结果
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        result = run_stage(args.run_stage, args.fixture, args.backend, args.model)
+        print(json.dumps(result), file=stdout)
+        return 0
+
+    if not shutil.which("ffmpeg"):
+        print("未找到 ffmpeg，无法生成测试视频")
+        return 2
+    lengths = [int(x) for x in args.lengths.split(",") if x.strip()]
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"未知阶段: {', '.join(sorted(unknown))}")
+
+    server = MockAPIServer(latency=args.latency, jitter=args.jitter, rpm=args.rpm).start()
+    results = []
+    print(f"{'时长':>8}  {'阶段':<12}{'耗时(s)':>10}{'RTF':>10}{'峰值RSS(MB)':>14}{'子进程RSS(MB)':>16}  备注")
+    try:
+        for seconds in lengths:
+            fixture = make_fixture(args.fixtures, seconds)
+            for stage in stages:
+                result = bench_stage(stage, fixture, seconds, args, server.env())
+                results.append(result)
+                note = result.get("error") or (f"{result['slices']} 个切片" if "slices" in result else "")
+                print(f"{seconds:>7}s  {stage:<12}{_fmt(result.get('seconds'), '.3f'):>10}{_fmt(result.get('rtf'), '.4f'):>10}"
+                      f"{_fmt(result.get('rss_mb'), '.1f'):>14}{_fmt(result.get('children_rss_mb'), '.1f'):>16}  {note}")
+    finally:
+        server.stop()
+    print(f"模拟接口统计: {json.dumps(dict(server.stats), ensure_ascii=False)}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    failed = False
+    for line in check_flat_memory(results, args.rss_growth):
+        print(f"内存随时长增长: {line}")
+        failed = True
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"性能退化: {line}")
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
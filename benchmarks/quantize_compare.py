@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+int8 量化对比：分别用 fp32 模型和 int8 动态量化模型（WHISPER_QUANTIZE=1）转写同一段音频，
+比较模型加载耗时（首次量化 / 读取磁盘缓存）、转写耗时、实时率、峰值内存，
+以及 int8 结果相对 fp32 结果的字符错误率（CER）。每次运行都在独立的子进程中进行。
+
+必须用 --audio 指定一段真实语音（几分钟的普通话讲话即可）：合成的测试视频没有语音，
+转写结果为空，CER 没有意义。可用 --reference 指定校对过的文本，分别计算两种模型相对参考文本的 CER。
+
+用法:
+    python benchmarks/quantize_compare.py --audio talk.mp3 --models tiny,small,medium
+    python benchmarks/quantize_compare.py --audio talk.mp3 --reference talk.txt --models small --json quant.json
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(ROOT))
+sys.path.insert(0, ROOT)
+
+from pipeline_bench import peak_rss_mb  # noqa: E402
+
+# (名称, 环境变量)；int8-build 在空缓存目录中量化并写入缓存，int8 读取缓存
+MODES = (
+    ("fp32", {"WHISPER_QUANTIZE": "0"}),
+    ("int8-build", {"WHISPER_QUANTIZE": "1"}),
+    ("int8", {"WHISPER_QUANTIZE": "1"}),
+)
+
+
+def cer(reference, hypothesis):
+    """字符错误率：忽略空白和标点后按字符计算编辑距离"""
+    ref = re.sub(r"[\W_]+", "", reference)
+    hyp = re.sub(r"[\W_]+", "", hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, start=1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, start=1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1] / len(ref)
+
+
+def run_child(audio, model):
+    """子进程：加载模型并转写整段音频"""
+    import exAudio
+    import speech2text
+    start = time.perf_counter()
+    speech2text.load_whisper(model)
+    load_seconds = time.perf_counter() - start
+    stats = {}
+    slices = list(exAudio.iter_audio_slices(audio, speech2text.preferred_slice_length(), stats=stats))
+    start = time.perf_counter()
+    texts = [result["text"] for _, result in
+             speech2text._iter_results(slices, "以下是普通话的句子。", speech2text.WHISPER_BATCH_SIZE)]
+    seconds = time.perf_counter() - start
+    own, _ = peak_rss_mb()
+    return {
+        "load_seconds": load_seconds,
+        "seconds": seconds,
+        "audio_seconds": stats["audio_seconds"],
+        "rss_mb": own,
+        "quantized": speech2text.whisper_quantized,
+        "text": "\n".join(texts),
+    }
+
+
+def run_mode(audio, model, mode_env, quantized_dir, workdir):
+    env = dict(os.environ, **mode_env)
+    env.update({
+        "PYTHONPATH": os.path.dirname(ROOT) + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        "WHISPER_QUANTIZED_DIR": quantized_dir,
+        "B2T_CACHE": "0",
+        "B2T_METRICS": "0",
+        "USE_OPENAI_WHISPER": "0",
+    })
+    env.pop("OPENAI_API_KEY", None)
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-child", "--audio", audio, "--models", model],
+        cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        encoding="utf-8", errors="replace",
+    )
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"退出码 {proc.returncode}"
+        return {"error": error}
+    return json.loads(lines[-1])
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whisper fp32 与 int8 动态量化对比")
+    parser.add_argument("--models", default="tiny,small", help="要对比的模型（逗号分隔，默认 tiny,small）")
+    parser.add_argument("--audio", required=True, help="包含真实语音的音频或视频文件")
+    parser.add_argument("--reference", help="校对过的参考文本文件，用于计算 CER")
+    parser.add_argument("--json", help="把结果（含转写文本）写入 JSON 文件")
+    parser.add_argument("--run-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_child:
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        print(json.dumps(run_child(args.audio, args.models), ensure_ascii=False), file=stdout)
+        return 0
+
+    audio = os.path.abspath(args.audio)
+    if not os.path.isfile(audio):
+        print(f"找不到音频文件: {args.audio}")
+        return 1
+    reference = None
+    if args.reference:
+        with open(args.reference, encoding="utf-8") as f:
+            reference = f.read()
+    results = []
+    print(f"{'模型':<10}{'模式':<12}{'加载(s)':>10}{'转写(s)':>10}{'RTF':>9}{'加速比':>8}{'峰值RSS(MB)':>13}"
+          f"{'CER(对fp32)':>13}{'CER(参考)':>11}  备注")
+    workdir = tempfile.mkdtemp(prefix="b2t-quant-")
+    try:
+        for model in [m.strip() for m in args.models.split(",") if m.strip()]:
+            quantized_dir = os.path.join(workdir, f"models-{model}")
+            baseline = None
+            for mode, mode_env in MODES:
+                result = dict(run_mode(audio, model, mode_env, quantized_dir, workdir), model=model, mode=mode)
+                results.append(result)
+                if "error" in result:
+                    print(f"{model:<10}{mode:<12}{'-':>10}{'-':>10}{'-':>9}{'-':>8}{'-':>13}{'-':>13}{'-':>11}  {result['error']}")
+                    continue
+                result["rtf"] = result["seconds"] / result["audio_seconds"] if result["audio_seconds"] else None
+                if mode == "fp32":
+                    baseline = result
+                else:
+                    if baseline:
+                        result["speedup"] = baseline["seconds"] / result["seconds"] if result["seconds"] else None
+                        result["cer_vs_fp32"] = cer(baseline["text"], result["text"])
+                if reference is not None:
+                    result["cer_vs_reference"] = cer(reference, result["text"])
+                note = "" if result["quantized"] or mode == "fp32" else "量化不可用，实际为 fp32"
+                print(f"{model:<10}{mode:<12}{result['load_seconds']:>10.2f}{result['seconds']:>10.2f}"
+                      f"{_fmt(result['rtf'], '.3f'):>9}{_fmt(result.get('speedup'), '.2f'):>8}{_fmt(result['rss_mb'], '.0f'):>13}"
+                      f"{_fmt(result.get('cer_vs_fp32'), '.2%'):>13}{_fmt(result.get('cer_vs_reference'), '.2%'):>11}  {note}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 1 if any("error" in r for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
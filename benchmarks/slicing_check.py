@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+语音活动检测切分的回归检查：用合成音频验证 SpeechSegmenter 在几类典型输入上的行为，
+任一检查失败时以非零状态退出，可以作为发布前的检查。
+
+- 持续背景音乐上的讲话、没有停顿的连续讲话：不能把语音当作噪声丢弃
+- 静音中夹杂讲话：丢弃静音，保留全部讲话
+- 纯静音：不产出切片
+- 切片长度不超过 15 秒（含默认最短长度）时不能报错，切片不超过最长长度
+
+用法:
+    python benchmarks/slicing_check.py
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exAudio import SAMPLE_RATE, SpeechSegmenter  # noqa: E402
+
+RNG = np.random.default_rng(0)
+
+
+def _speech(seconds, level=0.3):
+    """类语音信号：150Hz 基频的谐波，按 4Hz 音节节奏起伏但不中断"""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    carrier = sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 6))
+    envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * t) ** 2
+    return (level * carrier * envelope / np.max(np.abs(carrier))).astype(np.float32)
+
+
+def _noise(seconds, db):
+    return (RNG.standard_normal(int(seconds * SAMPLE_RATE)) * 10 ** (db / 20)).astype(np.float32)
+
+
+def _music(seconds, db=-6.0):
+    """持续的和弦，有效值约为 db dBFS"""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    chord = sum(np.sin(2 * np.pi * f * t) for f in (220.0, 277.2, 329.6))
+    return (chord / np.sqrt(np.mean(chord ** 2)) * 10 ** (db / 20)).astype(np.float32)
+
+
+def _segment(audio, slice_length=45000, vad=True):
+    segmenter = SpeechSegmenter(max_length=slice_length, vad=vad)
+    slices = []
+    for start in range(0, len(audio), SAMPLE_RATE * 10):
+        slices.extend(segmenter.feed(audio[start:start + SAMPLE_RATE * 10]))
+    slices.extend(segmenter.flush())
+    return slices
+
+
+def _kept(slices):
+    return sum(s["end"] - s["start"] for s in slices)
+
+
+def check_music_bed():
+    audio = _music(90) + _speech(90, level=0.2)
+    kept = _kept(_segment(audio))
+    return kept >= 90 * 0.95, f"保留 {kept:.1f}/90 秒"
+
+
+def check_continuous_speech():
+    audio = _speech(100) + _noise(100, -60)
+    kept = _kept(_segment(audio))
+    return kept >= 100 * 0.95, f"保留 {kept:.1f}/100 秒"
+
+
+def check_speech_with_silence():
+    parts, speech = [], []
+    for i in range(6):
+        parts += [_noise(10, -60), _speech(8)]
+        speech.append((i * 18 + 10, i * 18 + 18))
+    audio = np.concatenate(parts)
+    slices = _segment(audio)
+    covered = sum(
+        max(0.0, min(end, s["end"]) - max(start, s["start"])) for start, end in speech for s in slices)
+    kept = _kept(slices)
+    # 讲话全部保留；开头的 10 秒静音被丢弃（切片内部的停顿会保留）
+    ok = covered >= 48 * 0.98 and kept <= len(audio) / SAMPLE_RATE - 9
+    return ok, f"讲话保留 {covered:.1f}/48 秒，共保留 {kept:.1f}/{len(audio) / SAMPLE_RATE:.0f} 秒"
+
+
+def check_silence():
+    slices = _segment(_noise(60, -70))
+    return not slices, f"产出 {len(slices)} 个切片"
+
+
+def check_short_slices():
+    audio = np.concatenate([_speech(20), _noise(2, -60), _speech(40)])
+    details = []
+    ok = True
+    for slice_length in (5000, 10000, 15000):
+        try:
+            slices = _segment(audio, slice_length)
+        except Exception as e:
+            return False, f"slice_length={slice_length}: {type(e).__name__}: {e}"
+        longest = max(s["end"] - s["start"] for s in slices)
+        ok = ok and longest <= slice_length / 1000 + 1e-6
+        details.append(f"{slice_length}ms 最长 {longest:.1f}s")
+    return ok, "，".join(details)
+
+
+CHECKS = [
+    ("背景音乐上的讲话", check_music_bed),
+    ("连续讲话", check_continuous_speech),
+    ("静音中夹杂讲话", check_speech_with_silence),
+    ("纯静音", check_silence),
+    ("短切片", check_short_slices),
+]
+
+
+def main():
+    failed = 0
+    for name, check in CHECKS:
+        ok, detail = check()
+        failed += not ok
+        print(f"{name:<12}{'通过' if ok else '失败'}  {detail}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+本地持久化缓存：按内容哈希把结果保存为 JSON 文件，供转写、润色、下载元数据等复用。
+缓存目录默认为 ./cache，可通过 B2T_CACHE_DIR 修改；设置 B2T_CACHE=0 可关闭缓存。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+def enabled():
+    return str(os.getenv("B2T_CACHE", "1")).lower() not in ("0", "false", "no")
+
+
+def cache_dir():
+    return os.getenv("B2T_CACHE_DIR", "cache")
+
+
+def make_key(*parts):
+    """根据任意部件计算缓存键。bytes/memoryview 直接参与哈希，其余对象先序列化为 JSON。"""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            data = memoryview(part).cast("B")
+        else:
+            data = json.dumps(part, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        # 写入长度前缀，避免不同部件拼接后产生相同的字节串
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _entry_path(namespace, key):
+    return os.path.join(cache_dir(), namespace, key[:2], key + ".json")
+
+
+def get(namespace, key, ttl=None):
+    """读取缓存，未命中、已损坏或超过 ttl（秒）时返回 None"""
+    if not enabled():
+        return None
+    try:
+        with open(_entry_path(namespace, key), "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if ttl is not None and time.time() - entry.get("created", 0) > ttl:
+        return None
+    return entry.get("value")
+
+
+def put(namespace, key, value):
+    """写入缓存。先写临时文件再原子替换，多进程/多线程同时写入也不会留下半截文件。"""
+    if not enabled():
+        return
+    path = _entry_path(namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "value": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,152 @@
+"""
+转写断点：每个任务（以输出文件夹名标识）在 checkpoints/<文件夹>.jsonl 中记录任务信息，
+每转写完一个切片就追加一行结果。任务被停止或进程崩溃后，再次对同一文件夹执行转写会跳过已完成的切片。
+断点目录默认为 ./checkpoints，可通过 B2T_CHECKPOINT_DIR 修改。
+
+用法:
+    python checkpoint.py                  # 列出未完成的任务
+    python checkpoint.py <文件夹> [--model small]   # 从断点继续转写，默认使用断点中的模型（常驻服务运行时交给服务处理）
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+
+_lock = threading.Lock()
+
+
+def checkpoint_dir():
+    return os.getenv("B2T_CHECKPOINT_DIR", "checkpoints")
+
+
+def path(folder):
+    return os.path.join(checkpoint_dir(), f"{folder}.jsonl")
+
+
+def _append(folder, entry):
+    # 每条记录一次写入并立即落盘，崩溃时最多丢失正在写的一行
+    with _lock, open(path(folder), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load(folder):
+    """
+    读取断点，返回 {"job": 任务信息, "slices": {切片序号: 记录}, "finished": 是否已完成}；
+    不存在时返回 None。末尾写了一半的行会被忽略。
+    """
+    try:
+        f = open(path(folder), "r", encoding="utf-8")
+    except FileNotFoundError:
+        return None
+    state = {"job": None, "slices": {}, "finished": False}
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("type") == "job":
+                # 已完成的任务再次执行时会追加新的任务记录，此前的完成标记不再有效
+                state["job"] = entry
+                state["finished"] = False
+            elif entry.get("type") == "slice":
+                state["slices"][entry["index"]] = entry
+            elif entry.get("type") == "finished":
+                state["finished"] = True
+    return state if state["job"] else None
+
+
+def begin(folder, resume=False, **info):
+    """
+    开始或继续一个任务。已有断点且提示词、转写后端与 info 一致时返回已完成的切片 {序号: 记录}；
+    否则新建断点并返回空字典。info 中的 file_id、link、mode、slice_length 用于之后恢复任务。
+    resume 为 True（明确要求从断点继续）时不一致会抛出 RuntimeError，不会清空已完成的切片。
+    """
+    os.makedirs(checkpoint_dir(), exist_ok=True)
+    state = load(folder)
+    if state:
+        job = state["job"]
+        mismatched = [k for k in ("prompt", "backend") if job.get(k) != info.get(k)]
+        if not mismatched:
+            _append(folder, dict(job, type="job", resumed=time.time()))
+            return state["slices"]
+        if resume:
+            names = {"prompt": "提示词", "backend": "转写后端"}
+            raise RuntimeError(f"断点中的{'、'.join(names[k] for k in mismatched)}与当前不同（{job.get(mismatched[0])} ≠ "
+                               f"{info.get(mismatched[0])}），无法继续；已完成的切片保留在 {path(folder)}")
+        print("断点中的提示词或转写模型与当前不同，重新开始转写")
+    with _lock, open(path(folder), "w", encoding="utf-8") as f:
+        f.write(json.dumps(dict(info, type="job", folder=folder, created=time.time()), ensure_ascii=False) + "\n")
+    return {}
+
+
+def add_slice(folder, audio_slice, result):
+    """记录一个已完成切片的转写结果"""
+    entry = {"type": "slice", "index": audio_slice.get("index"), "result": result}
+    for field in ("start", "end"):
+        if field in audio_slice:
+            entry[field] = audio_slice[field]
+    _append(folder, entry)
+
+
+def matches(record, audio_slice):
+    """断点中的记录与重新生成的切片是否对应同一段音频（序号与起止时间都相同）"""
+    return all(record.get(k) == audio_slice.get(k) for k in ("index", "start", "end"))
+
+
+def finish(folder):
+    _append(folder, {"type": "finished", "time": time.time()})
+
+
+def unfinished():
+    """按修改时间从新到旧列出未完成任务的信息，附带已完成的切片数"""
+    jobs = []
+    files = sorted(glob.glob(os.path.join(checkpoint_dir(), "*.jsonl")), key=os.path.getmtime, reverse=True)
+    for file in files:
+        state = load(os.path.splitext(os.path.basename(file))[0])
+        if state and not state["finished"]:
+            jobs.append(dict(state["job"], completed=len(state["slices"])))
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bili2text 转写断点")
+    parser.add_argument("folder", nargs="?", help="要继续的任务文件夹；省略时列出未完成的任务")
+    parser.add_argument("--model", help="Whisper 模型名称，默认使用断点中记录的模型")
+    args = parser.parse_args()
+
+    if not args.folder:
+        jobs = unfinished()
+        if not jobs:
+            print("没有未完成的任务。")
+        for job in jobs:
+            print(f"{job['folder']}  {job.get('file_id') or '-'}  已完成 {job['completed']} 个切片  "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['created']))}")
+        return 0
+    if load(args.folder) is None:
+        print(f"没有找到断点: {path(args.folder)}")
+        return 1
+
+    import daemon
+    import speech2text
+    model = args.model or speech2text.resume_model(args.folder) or "small"
+    if daemon.is_running():
+        job = daemon.wait(daemon.submit(folder=args.folder, resume=True, model=model)["id"])
+        if job["status"] != "done":
+            print("转换失败！", job.get("error") or job["status"])
+            return 1
+        print("转换完成！", job.get("output"))
+        return 0
+    speech2text.load_whisper(model)
+    speech2text.resume_analysis(args.folder)
+    print("转换完成！", f"outputs/{args.folder}.md")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+常驻转写服务：Whisper 模型只在启动时加载一次，通过本地 HTTP 接口接收任务并报告进度。
+GUI（window.py）、main.py 和脚本检测到服务在运行时会把任务提交给它，省去每次运行重新加载模型的时间。
+任务按提交顺序由同一个工作线程依次执行；客户端函数只依赖 requests，不会导入 Whisper。
+
+用法:
+    python daemon.py serve --model small        # 启动服务，默认监听 127.0.0.1:8760
+    python daemon.py submit BV1xxxx --wait      # 提交任务并输出进度直到完成
+    python daemon.py status <任务ID>
+    python daemon.py cancel <任务ID>
+
+接口:
+    GET  /health              服务状态与已加载的模型
+    GET  /jobs                全部任务（不含日志）
+    POST /jobs                提交任务 {"link", "prompt", "model", "refine"}，返回任务信息；
+                              只给出 {"folder", "refine": true} 时对已有转写结果进行润色；
+                              {"folder", "resume": true} 从断点继续转写中断的任务
+    GET  /jobs/<id>?since=N   任务状态，log 只包含第 N 行之后的日志，next 为下次查询的起点
+    POST /jobs/<id>/cancel    停止任务
+"""
+import argparse
+import contextvars
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+DAEMON_URL = os.getenv("B2T_DAEMON_URL", "http://127.0.0.1:8760")
+MAX_LOG_LINES = 5000  # 每个任务保留的日志行数
+DEFAULT_PROMPT = "以下是普通话的句子。这是一个关于{}的视频。"
+
+
+# ---------------- 客户端 ----------------
+
+def _api(method, path, **kwargs):
+    resp = requests.request(method, DAEMON_URL.rstrip("/") + path, timeout=kwargs.pop("timeout", 10), **kwargs)
+    if not resp.ok:
+        raise RuntimeError(f"转写服务返回错误: {resp.status_code} {resp.text}")
+    return resp.json()
+
+
+def is_running():
+    """检测常驻转写服务是否可用"""
+    try:
+        return _api("GET", "/health", timeout=0.5).get("status") == "ok"
+    except (requests.RequestException, RuntimeError, ValueError):
+        return False
+
+
+def submit(link=None, prompt=None, model=None, refine=False, folder=None, resume=False):
+    """提交任务，返回任务信息（含 id）"""
+    payload = {"link": link, "prompt": prompt, "model": model, "refine": refine, "folder": folder, "resume": resume}
+    return _api("POST", "/jobs", json={k: v for k, v in payload.items() if v is not None})
+
+
+def get_job(job_id, since=0):
+    return _api("GET", f"/jobs/{job_id}?since={since}")
+
+
+def cancel(job_id):
+    return _api("POST", f"/jobs/{job_id}/cancel")
+
+
+def wait(job_id, on_log=print, stop_event=None, interval=0.5):
+    """
+    轮询任务直到结束，新的日志行逐行交给 on_log。
+    stop_event 被设置时向服务发送停止请求，并继续等待任务真正结束。
+    返回任务最终状态。
+    """
+    since = 0
+    cancelled = False
+    while True:
+        if stop_event is not None and stop_event.is_set() and not cancelled:
+            cancel(job_id)
+            cancelled = True
+        job = get_job(job_id, since)
+        for line in job.pop("log", []):
+            on_log(line)
+        since = job.pop("next", since)
+        if job["status"] in ("done", "failed", "cancelled"):
+            return job
+        time.sleep(interval)
+
+
+# ---------------- 服务端 ----------------
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_queue = queue.Queue()
+_job_ids = itertools.count(1)
+_models = {}  # 已加载的模型，切换回来时不必重新加载
+_default_model = None
+
+
+class _JobLogRouter:
+    """
+    替换 sys.stdout/stderr：输出照常写到控制台，任务执行期间的输出同时记入该任务的日志。
+    当前任务保存在 contextvars 中，转写/润色/管线创建子线程时复制上下文，子线程的输出也归到同一任务。
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.job = contextvars.ContextVar("b2t_daemon_job", default=None)
+
+    def write(self, text):
+        self.stream.write(text)
+        job = self.job.get()
+        if job is None or not text:
+            return
+        with _jobs_lock:
+            buffer = job["_partial"] + text
+            lines = buffer.split("\n")
+            job["_partial"] = lines.pop()
+            job["log"].extend(line for line in lines if line.strip())
+            overflow = len(job["log"]) - MAX_LOG_LINES
+            if overflow > 0:
+                del job["log"][:overflow]
+                job["log_base"] += overflow
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _public(job, since=None):
+    """任务信息的对外视图；since 不为空时附带该行之后的日志"""
+    info = {k: v for k, v in job.items() if not k.startswith("_") and k not in ("log", "log_base")}
+    if since is not None:
+        start = max(since - job["log_base"], 0)
+        info["log"] = job["log"][start:]
+        info["next"] = job["log_base"] + len(job["log"])
+    return info
+
+
+def _update(job, **fields):
+    with _jobs_lock:
+        job.update(fields)
+
+
+def _ensure_model(name):
+    """切换到任务指定的模型：已加载过的直接复用，否则加载一次"""
+    import speech2text
+    if not name or name == speech2text.whisper_model_name or speech2text.USE_OPENAI_API:
+        return
+    if name in _models and speech2text._worker_pool is None:
+        speech2text.whisper_model, speech2text.whisper_quantized = _models[name]
+        speech2text.whisper_model_name = name
+        return
+    speech2text.load_whisper(model=name)
+    if speech2text._worker_pool is None:
+        _models[name] = (speech2text.whisper_model, speech2text.whisper_quantized)
+
+
+def _check_stop(stop):
+    if stop.is_set():
+        raise KeyboardInterrupt("用户请求停止任务")
+
+
+def _run_job(job):
+    import speech2text
+    from exAudio import process_audio_memory, process_audio_split, use_in_memory_audio
+    from pipeline import run_pipeline, use_stream_pipeline
+    from utils import download_video
+
+    stop = job["_stop"]
+    speech2text.set_stop_event(stop)
+    folder_name = job.get("folder")
+    prompt = job.get("prompt")
+    if job.get("link"):
+        _ensure_model(job.get("model") or _default_model)
+        slice_length = speech2text.preferred_slice_length()
+        if use_stream_pipeline():
+            _update(job, stage="transcribing")
+            file_id, folder_name = run_pipeline(job["link"], speech2text, prompt=prompt, slice_length=slice_length)
+        else:
+            _update(job, stage="downloading")
+            file_id = download_video(job["link"])
+            if file_id is None:
+                raise RuntimeError("视频下载失败，请检查网络连接或视频链接是否正确。")
+            _check_stop(stop)
+            _update(job, stage="splitting", file_id=file_id)
+            slices = None
+            if use_in_memory_audio():
+                folder_name, slices = process_audio_memory(file_id, slice_length)
+            else:
+                folder_name = process_audio_split(file_id, slice_length)
+            _check_stop(stop)
+            _update(job, stage="transcribing", folder=folder_name)
+            speech2text.run_analysis(folder_name, prompt=prompt or DEFAULT_PROMPT.format(file_id), slices=slices,
+                                     job_info={"file_id": file_id, "link": job["link"], "slice_length": slice_length})
+        _check_stop(stop)
+        _update(job, file_id=file_id, folder=folder_name, output=f"outputs/{folder_name}.md")
+        print("转换完成！原始文档已保存：", f"outputs/{folder_name}.md")
+    elif job.get("resume"):
+        # 优先使用断点中记录的模型，换用其他模型会使已完成的切片无法复用
+        _ensure_model(speech2text.resume_model(folder_name) or job.get("model") or _default_model)
+        _update(job, stage="transcribing")
+        speech2text.resume_analysis(folder_name, prompt=prompt)
+        _check_stop(stop)
+        _update(job, output=f"outputs/{folder_name}.md")
+        print("转换完成！原始文档已保存：", f"outputs/{folder_name}.md")
+    if job.get("refine"):
+        _update(job, stage="refining")
+        speech2text.refine_text(folder_name, prompt=prompt or DEFAULT_PROMPT.format(folder_name))
+        _check_stop(stop)
+        _update(job, refined_output=f"outputs/{folder_name}_refined.md")
+        print("AI润色完成！润色文档已保存：", f"outputs/{folder_name}_refined.md")
+
+
+def _worker():
+    """唯一的工作线程：模型不是线程安全的，任务按提交顺序依次执行"""
+    while True:
+        job = _job_queue.get()
+        if job["status"] == "cancelled":
+            continue
+        _update(job, status="running", started=time.time())
+        token = sys.stdout.job.set(job)
+        try:
+            _run_job(job)
+            _update(job, status="done", stage=None)
+        except KeyboardInterrupt:
+            print("任务已停止")
+            _update(job, status="cancelled")
+        except Exception as e:
+            print(f"处理过程中发生错误: {e}")
+            _update(job, status="cancelled" if job["_stop"].is_set() else "failed", error=str(e))
+        finally:
+            sys.stdout.job.reset(token)
+            _update(job, finished=time.time())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass  # 轮询请求很频繁，不打印访问日志
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _find(self, job_id):
+        with _jobs_lock:
+            return _jobs.get(job_id)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["health"]:
+            import speech2text
+            return self._reply(200, {"status": "ok", "model": speech2text.whisper_model_name,
+                                     "loaded": sorted(_models), "queued": _job_queue.qsize()})
+        if parts == ["jobs"]:
+            with _jobs_lock:
+                return self._reply(200, [_public(job) for job in _jobs.values()])
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = self._find(parts[1])
+            if job is None:
+                return self._reply(404, {"error": "任务不存在"})
+            try:
+                since = int(urllib.parse.parse_qs(url.query).get("since", ["0"])[0])
+            except ValueError:
+                return self._reply(400, {"error": "since 必须是整数"})
+            with _jobs_lock:
+                return self._reply(200, _public(job, since))
+        self._reply(404, {"error": "未知接口"})
+
+    def do_POST(self):
+        parts = [p for p in urllib.parse.urlparse(self.path).path.split("/") if p]
+        if parts == ["jobs"]:
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            except ValueError:
+                return self._reply(400, {"error": "请求体不是合法的 JSON"})
+            if not isinstance(payload, dict):
+                return self._reply(400, {"error": "请求体必须是 JSON 对象"})
+            if not payload.get("link") and not (payload.get("folder") and (payload.get("refine") or payload.get("resume"))):
+                return self._reply(400, {"error": "需要提供 link，或 folder 与 refine/resume"})
+            job = {
+                "id": str(next(_job_ids)),
+                "link": payload.get("link"),
+                "folder": payload.get("folder"),
+                "prompt": payload.get("prompt"),
+                "model": payload.get("model"),
+                "refine": bool(payload.get("refine")),
+                "resume": bool(payload.get("resume")),
+                "status": "queued",
+                "stage": None,
+                "created": time.time(),
+                "error": None,
+                "log": [],
+                "log_base": 0,
+                "_partial": "",
+                "_stop": threading.Event(),
+            }
+            with _jobs_lock:
+                _jobs[job["id"]] = job
+            _job_queue.put(job)
+            return self._reply(200, _public(job))
+        if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+            job = self._find(parts[1])
+            if job is None:
+                return self._reply(404, {"error": "任务不存在"})
+            job["_stop"].set()
+            with _jobs_lock:
+                if job["status"] == "queued":
+                    job["status"] = "cancelled"
+                return self._reply(200, _public(job))
+        self._reply(404, {"error": "未知接口"})
+
+
+def serve(model="small", host="127.0.0.1", port=8760):
+    global _default_model
+    import speech2text
+    sys.stdout = _JobLogRouter(sys.stdout)
+    sys.stderr = sys.stdout
+    _default_model = model
+    speech2text.load_whisper(model=model)
+    if speech2text._worker_pool is None and speech2text.whisper_model is not None:
+        _models[model] = (speech2text.whisper_model, speech2text.whisper_quantized)
+    threading.Thread(target=_worker, daemon=True).start()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    print(f"转写服务已启动: http://{host}:{port}（模型: {model}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("转写服务已停止")
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bili2text 常驻转写服务")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("serve", help="启动服务并加载模型")
+    p.add_argument("--model", default="small", help="启动时加载的 Whisper 模型（默认 small）")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=int(urllib.parse.urlparse(DAEMON_URL).port or 8760))
+    p = sub.add_parser("submit", help="提交视频链接或BV号")
+    p.add_argument("link")
+    p.add_argument("--model", help="使用的 Whisper 模型，默认使用服务启动时加载的模型")
+    p.add_argument("--prompt")
+    p.add_argument("--refine", action="store_true", help="转写完成后进行AI润色")
+    p.add_argument("--wait", action="store_true", help="等待任务完成并输出日志")
+    p = sub.add_parser("status", help="查看任务状态")
+    p.add_argument("job_id")
+    p = sub.add_parser("cancel", help="停止任务")
+    p.add_argument("job_id")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.model, args.host, args.port)
+        return 0
+    if args.command == "submit":
+        job = submit(args.link, prompt=args.prompt, model=args.model, refine=args.refine)
+        print(f"任务已提交: {job['id']}")
+        if not args.wait:
+            return 0
+        try:
+            job = wait(job["id"])
+        except KeyboardInterrupt:
+            cancel(job["id"])
+            print("已请求停止任务")
+            return 1
+    elif args.command == "status":
+        job = get_job(args.job_id)
+        job.pop("log", None)
+        job.pop("next", None)
+    else:
+        job = cancel(args.job_id)
+    print(json.dumps(job, ensure_ascii=False, indent=2))
+    return 0 if job["status"] != "failed" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,217 @@
-from moviepy.editor import VideoFileClip
-from pydub import AudioSegment
 import os
+import io
+import json
 import time
+import wave
 import subprocess
+import tempfile
+import numpy as np
+import cache
+import metrics
 
-def check_video_integrity(file_path):
-    """使用 FFmpeg 验证视频文件完整性"""
-    result = subprocess.run(
-        ['ffmpeg', '-v', 'error', '-i', file_path, '-f', 'null', '-'],
-        stderr=subprocess.PIPE,
-        text=True
-    )
-    if result.stderr:
+SAMPLE_RATE = 16000  # Whisper 模型使用的采样率
+VAD_FRAME_MS = 30  # 语音活动检测的帧长
+DECODE_CHUNK_SECONDS = 10  # 流式解码时每次从 FFmpeg 读取的音频时长
+INTEGRITY_LEVELS = ("probe", "audio", "full")
+
+
+def use_in_memory_audio():
+    """是否启用内存模式：源文件只解码一次，切片直接以 NumPy 数组交给 Whisper"""
+    return str(os.getenv("IN_MEMORY_AUDIO", "0")).lower() not in ("0", "false", "no")
+
+def use_vad_slicing():
+    """是否按语音活动切分（默认开启，设置 VAD_SLICING=0 恢复固定时长切分）"""
+    return str(os.getenv("VAD_SLICING", "1")).lower() not in ("0", "false", "no")
+
+
+class SpeechSegmenter:
+    """
+    基于能量的语音活动检测（VAD）切分器。
+    以流式方式接收 16kHz 单声道 PCM，在停顿处切分，丢弃没有语音的片段，
+    并记录每个切片在源音频中的起止时间（秒）。vad=False 时退化为按固定时长切分。
+    """
+    def __init__(self, max_length=45000, min_length=15000, sr=SAMPLE_RATE, vad=True,
+                 threshold_db=12.0, floor_db=-50.0, pad_ms=200, hangover_ms=300, min_speech_ms=300):
+        self.sr = sr
+        self.vad = vad
+        self.frame = sr * VAD_FRAME_MS // 1000
+        self.max_samples = sr * max_length // 1000
+        # 最短长度必须小于最长长度，否则寻找停顿的区间为空
+        self.min_samples = min(sr * min_length // 1000, self.max_samples // 2)
+        self.threshold_db = threshold_db  # 高于噪声底多少 dB 判为语音
+        self.floor_db = floor_db  # 绝对静音阈值（dBFS）
+        self.pad = sr * pad_ms // 1000  # 语音前后保留的余量
+        self.hangover = max(1, hangover_ms // VAD_FRAME_MS)  # 语音帧向后延续，避免截断词尾
+        self.min_speech_frames = max(1, min_speech_ms // VAD_FRAME_MS)
+        self._buf = np.zeros(0, np.float32)
+        self._offset = 0  # 缓冲区起点在源音频中的采样位置
+        self._index = 0
+
+    def feed(self, samples):
+        """追加 PCM 数据，返回已经能确定边界的切片列表"""
+        self._buf = np.concatenate([self._buf, np.asarray(samples, np.float32)])
+        slices = []
+        while len(self._buf) >= self.max_samples:
+            slices.extend(self._process(final=False))
+        return slices
+
+    def flush(self):
+        """输入结束，处理缓冲区剩余的音频"""
+        slices = []
+        while len(self._buf):
+            slices.extend(self._process(final=True))
+        return slices
+
+    def _speech_mask(self, window):
+        n = (len(window) + self.frame - 1) // self.frame
+        frames = np.zeros(n * self.frame, np.float32)
+        frames[:len(window)] = window
+        frames = frames.reshape(n, self.frame)
+        db = 20 * np.log10(np.sqrt(np.mean(frames ** 2, axis=1)) + 1e-10)
+        # 自适应阈值：以窗口内较安静的帧估计噪声底
+        noise_floor = np.percentile(db, 10)
+        threshold = max(noise_floor + self.threshold_db, self.floor_db)
+        if threshold >= np.median(db) and noise_floor > self.floor_db + self.threshold_db:
+            # 大部分帧都低于阈值，而“最安静”的帧也并不安静：多半是背景音乐或没有停顿的连续讲话，
+            # 估计不出可靠的噪声底。宁可多保留，只丢弃绝对静音的帧
+            threshold = self.floor_db
+        mask = db > threshold
+        mask = np.convolve(mask, np.ones(self.hangover), mode="full")[:n] > 0
+        return mask, db
+
+    def _find_cut(self, mask, db):
+        """在 [min_length, max_length] 区间内寻找最长的停顿，在其中点切分"""
+        start = self.min_samples // self.frame
+        if start >= len(mask):
+            return self.max_samples  # 没有可以搜索的区间，按最长长度硬切
+        best, best_len, run = None, 0, 0
+        for i in range(start, len(mask)):
+            run = 0 if mask[i] else run + 1
+            if run and run >= best_len:
+                best, best_len = i - run // 2, run
+        if best is None:
+            # 没有停顿时，在窗口后三分之一能量最低的帧处切分
+            tail = max(start, len(db) * 2 // 3)
+            best = tail + int(np.argmin(db[tail:]))
+        return max(best, 1) * self.frame
+
+    def _process(self, final):
+        window = self._buf[:self.max_samples]
+        if not self.vad:
+            return self._emit(0, len(window), len(window))
+        mask, db = self._speech_mask(window)
+        if not mask.any():
+            # 整个窗口都没有语音，直接丢弃（非最终阶段保留少量余量作为下一段的前导）
+            self._consume(len(window) if final else max(len(window) - self.pad, self.frame))
+            return []
+        lead = int(np.argmax(mask)) * self.frame - self.pad
+        if lead >= self.frame:
+            # 丢弃开头的静音/非语音部分
+            self._consume(lead)
+            return []
+        if len(self._buf) > len(window) or not final:
+            cut = min(self._find_cut(mask, db), len(window))
+        else:
+            cut = len(window)
+        kept = mask[:(cut + self.frame - 1) // self.frame]
+        if kept.sum() < self.min_speech_frames:
+            self._consume(cut)
+            return []
+        last = len(kept) - int(np.argmax(kept[::-1]))
+        end = min(cut, last * self.frame + self.pad)
+        return self._emit(0, end, cut)
+
+    def _emit(self, start, end, consumed):
+        self._index += 1
+        audio_slice = {
+            "index": self._index,
+            "start": (self._offset + start) / self.sr,
+            "end": (self._offset + end) / self.sr,
+            "audio": self._buf[start:end].copy(),
+        }
+        self._consume(consumed)
+        return [audio_slice]
+
+    def _consume(self, n):
+        self._buf = self._buf[n:]
+        self._offset += n
+
+def integrity_level():
+    """
+    视频完整性校验级别（INTEGRITY_CHECK）：
+    probe 只读取容器与流信息；audio（默认）再解码一遍音轨；full 完整解码音视频（最慢，仅在排查问题时使用）
+    """
+    level = str(os.getenv("INTEGRITY_CHECK", "audio")).lower()
+    return level if level in INTEGRITY_LEVELS else "audio"
+
+def probe_media(file_path):
+    """
+    使用 ffprobe 读取容器时长与各个流的类型，不解码任何数据。
+    返回 {"duration": 秒或None, "streams": ["video", "audio", ...]}；未安装 ffprobe 时返回 None。
+    文件无法解析时抛出 ValueError。
+    """
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:stream=codec_type', '-of', 'json', file_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+    except FileNotFoundError:
+        return None
+    if result.returncode != 0:
+        raise ValueError(result.stderr.strip() or "ffprobe 无法解析文件")
+    info = json.loads(result.stdout or "{}")
+    try:
+        duration = float(info.get("format", {}).get("duration"))
+    except (TypeError, ValueError):
+        duration = None
+    return {"duration": duration, "streams": [s.get("codec_type") for s in info.get("streams", [])]}
+
+def check_video_integrity(file_path, level=None):
+    """
+    分级校验视频文件完整性：先用 ffprobe 检查容器和音轨，再按级别决定是否解码。
+    默认只解码音轨（跳过视频解码），INTEGRITY_CHECK=full 时才完整解码。
+    通过校验的结果按文件路径、大小和修改时间缓存，同一文件不会重复校验。
+    """
+    level = level or integrity_level()
+    with metrics.timed("integrity", level=level, bytes=os.path.getsize(file_path)) as m:
+        m["ok"] = _check_video_integrity(file_path, level, m)
+        return m["ok"]
+
+def _check_video_integrity(file_path, level, m):
+    stat = os.stat(file_path)
+    key = cache.make_key("integrity-v1", os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, level)
+    if cache.get("integrity", key):
+        m["cached"] = True
+        return True
+    try:
+        info = probe_media(file_path)
+    except ValueError as e:
         print(f"视频文件可能损坏: {file_path}")
-        print(f"FFmpeg 错误信息: {result.stderr}")
+        print(f"FFprobe 错误信息: {e}")
         return False
+    if info is not None:
+        if "audio" not in info["streams"]:
+            print(f"视频文件中没有音轨: {file_path}")
+            return False
+        if not info["duration"]:
+            print(f"视频文件缺少时长信息，可能未下载完整: {file_path}")
+            return False
+    if level != "probe" or info is None:
+        cmd = ['ffmpeg', '-v', 'error', '-i', file_path]
+        if level != "full":
+            cmd += ['-map', '0:a:0', '-vn', '-sn', '-dn']
+        result = subprocess.run(cmd + ['-f', 'null', '-'], stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0 or result.stderr:
+            print(f"视频文件可能损坏: {file_path}")
+            print(f"FFmpeg 错误信息: {result.stderr}")
+            return False
+    cache.put("integrity", key, True)
     return True
 
-def convert_flv_to_mp3(name, target_name=None, folder='bilibili_video'):
+def find_video_file(name, folder='bilibili_video'):
+    """查找已下载的视频文件并校验完整性，必要时重新封装，返回可用的文件路径"""
     # 先尝试直接拼接 .mp4
     input_path = f'{folder}/{name}.mp4'
     if not os.path.exists(input_path):
@@ -25,7 +219,9 @@ def convert_flv_to_mp3(name, target_name=None, folder='bilibili_video'):
         dir_path = f'{folder}/{name}'
         if os.path.isdir(dir_path):
             # 按格式优先级选择，避免旧的损坏 webm 被选中
-            priority_exts = ['.mp4', '.m4v', '.mov', '.mkv', '.flv', '.webm', '.avi']
+            # 只下载音轨（AUDIO_ONLY）时目录中是音频文件，排在视频格式之后
+            priority_exts = ['.mp4', '.m4v', '.mov', '.mkv', '.flv', '.webm', '.avi',
+                             '.m4a', '.mp3', '.aac', '.opus', '.ogg', '.wav', '.flac']
             found = None
             for ext in priority_exts:
                 for file in os.listdir(dir_path):
@@ -56,32 +252,151 @@ def convert_flv_to_mp3(name, target_name=None, folder='bilibili_video'):
                 raise ValueError(f"视频文件损坏: {input_path}")
         except Exception:
             raise ValueError(f"视频文件损坏: {input_path}")
-    # 提取视频中的音频并保存为 MP3 到 audio/conv 目录
-    clip = VideoFileClip(input_path)
-    audio = clip.audio
-    os.makedirs("audio/conv", exist_ok=True)
-    output_name = target_name if target_name else name
-    audio.write_audiofile(f"audio/conv/{output_name}.mp3")
+    return input_path
+
+def convert_flv_to_mp3(name, target_name=None, folder='bilibili_video'):
+    input_path = find_video_file(name, folder)
+    # 提取音频并保存为 MP3 到 audio/conv 目录。AudioFileClip 只打开音轨，视频文件和纯音频文件都适用
+    from moviepy.editor import AudioFileClip
+    with metrics.timed("extract", bytes=os.path.getsize(input_path)) as m:
+        audio = AudioFileClip(input_path)
+        m["audio_seconds"] = audio.duration
+        os.makedirs("audio/conv", exist_ok=True)
+        output_name = target_name if target_name else name
+        try:
+            audio.write_audiofile(f"audio/conv/{output_name}.mp3")
+        finally:
+            audio.close()
+
+def iter_audio_chunks(file_path, sr=SAMPLE_RATE, chunk_seconds=DECODE_CHUNK_SECONDS):
+    """
+    通过 FFmpeg 管道流式解码为单声道 float32 PCM，每次产出约 chunk_seconds 秒，
+    内存占用与源文件时长无关。生成器提前关闭时结束 FFmpeg 进程。
+    """
+    # 损坏的文件每个坏包都会输出一行错误，写入临时文件而不是管道，避免管道写满后 FFmpeg 阻塞
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        ['ffmpeg', '-nostdin', '-v', 'error', '-threads', '0', '-i', file_path,
+         '-vn', '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(sr), 'pipe:1'],
+        stdout=subprocess.PIPE,
+        stderr=stderr
+    )
+    try:
+        while True:
+            data = proc.stdout.read(sr * 2 * chunk_seconds)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 2 * 2], np.int16).astype(np.float32) / 32768.0
+        if proc.wait() != 0:
+            raise RuntimeError(f"音频解码失败: {read_stderr_tail(stderr)}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        stderr.close()
+
+def read_stderr_tail(f, limit=4096):
+    """读取保存 FFmpeg 错误输出的临时文件的末尾部分"""
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell() - limit))
+    return f.read().decode('utf-8', errors='ignore').strip()
+
+def iter_audio_slices(file_path, slice_length=45000, sr=SAMPLE_RATE, vad=None, stats=None):
+    """
+    流式解码并切分音频文件，每确定一个切片就立即产出（index/start/end 单位为秒，audio 为 PCM 数组）。
+    内存中只保留当前窗口（不超过 slice_length）和一个解码块；stats 不为空时写入 audio_seconds 与 slices。
+    """
+    if vad is None:
+        vad = use_vad_slicing()
+    segmenter = SpeechSegmenter(max_length=slice_length, sr=sr, vad=vad)
+    total = kept = count = 0
+    for chunk in iter_audio_chunks(file_path, sr):
+        total += len(chunk)
+        for audio_slice in segmenter.feed(chunk):
+            kept += audio_slice["end"] - audio_slice["start"]
+            count += 1
+            yield audio_slice
+    for audio_slice in segmenter.flush():
+        kept += audio_slice["end"] - audio_slice["start"]
+        count += 1
+        yield audio_slice
+    if vad:
+        print(f"语音检测：保留 {kept:.1f}s / {total / sr:.1f}s 音频")
+    if stats is not None:
+        stats["audio_seconds"] = total / sr
+        stats["slices"] = count
 
 def split_mp3(filename, folder_name, slice_length=45000, target_folder="audio/slice"):
-    audio = AudioSegment.from_mp3(filename)
-    total_slices = (len(audio)+ slice_length - 1) // slice_length
-    target_dir = os.path.join(target_folder, folder_name)
-    os.makedirs(target_dir, exist_ok=True)
-    for i in range(total_slices):
-        start = i * slice_length
-        end = start + slice_length
-        slice_audio = audio[start:end]
-        slice_path = os.path.join(target_dir, f"{i+1}.mp3")
-        slice_audio.export(slice_path, format="mp3")
-        print(f"Slice {i+1} saved: {slice_path}")
-
-def process_audio_split(name):
-    # 生成唯一文件夹名，并依次调用转换和分割函数
+    """流式切分音频文件并逐个导出为 MP3 切片，峰值内存与音频时长无关"""
+    from pydub import AudioSegment
+    with metrics.timed("split", mode="files", bytes=os.path.getsize(filename)) as m:
+        target_dir = os.path.join(target_folder, folder_name)
+        os.makedirs(target_dir, exist_ok=True)
+        manifest = []
+        for audio_slice in iter_audio_slices(filename, slice_length, stats=m):
+            slice_path = os.path.join(target_dir, f"{audio_slice['index']}.mp3")
+            pcm = (np.clip(audio_slice["audio"], -1.0, 1.0) * 32767).astype(np.int16)
+            AudioSegment(pcm.tobytes(), sample_width=2, frame_rate=SAMPLE_RATE, channels=1).export(slice_path, format="mp3")
+            manifest.append({
+                "index": audio_slice["index"],
+                "file": os.path.basename(slice_path),
+                "start": audio_slice["start"],
+                "end": audio_slice["end"],
+            })
+            print(f"Slice {audio_slice['index']} saved: {slice_path} ({audio_slice['start']:.1f}s - {audio_slice['end']:.1f}s)")
+        # 记录每个切片在源音频中的偏移，便于时间戳映射回原视频
+        with open(os.path.join(target_dir, "slices.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+def array_to_wav_bytes(audio, sr=SAMPLE_RATE):
+    """将 float32 PCM 编码为内存中的 WAV（用于需要文件上传的云端接口）"""
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sr)
+        wf.writeframes(pcm.tobytes())
+    return buf.getvalue()
+
+def encode_opus(file_path=None, audio=None, bitrate="24k", sr=SAMPLE_RATE):
+    """
+    将音频文件或 float32 PCM 重新编码为低码率单声道 Opus（Ogg 封装），返回字节串。
+    用于上传前压缩体积，语音在 24kbps 下几乎不影响识别效果。
+    """
+    pcm = None
+    source = ['-i', file_path]
+    if audio is not None:
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+        source = ['-f', 's16le', '-ac', '1', '-ar', str(sr), '-i', 'pipe:0']
+    result = subprocess.run(
+        ['ffmpeg', '-nostdin', '-v', 'error', *source, '-vn', '-ac', '1', '-ar', str(sr),
+         '-c:a', 'libopus', '-b:a', bitrate, '-application', 'voip', '-f', 'ogg', 'pipe:1'],
+        input=pcm,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Opus 编码失败: {result.stderr.decode('utf-8', errors='ignore')}")
+    return result.stdout
+
+def process_audio_memory(name, slice_length=45000):
+    """内存模式：直接从视频解码出 16kHz 单声道 PCM 并切片，不生成中间 MP3 文件"""
     folder_name = time.strftime('%Y%m%d%H%M%S')
+    input_path = find_video_file(name)
+    with metrics.timed("split", mode="memory", bytes=os.path.getsize(input_path)) as m:
+        # 流式解码：只保留切片本身，不再同时持有整段 PCM 及其解码缓冲
+        slices = list(iter_audio_slices(input_path, slice_length, stats=m))
+    print(f"音频已解码到内存，共 {len(slices)} 个切片")
+    return folder_name, slices
+
+def process_audio_split(name, slice_length=45000, folder_name=None):
+    # 生成唯一文件夹名（并发处理多个视频时由调用方指定），并依次调用转换和分割函数
+    folder_name = folder_name or time.strftime('%Y%m%d%H%M%S')
     convert_flv_to_mp3(name, target_name=folder_name)
     conv_path = f"audio/conv/{folder_name}.mp3"
     if not os.path.exists(conv_path):
         raise FileNotFoundError(f"转换后的音频文件不存在: {conv_path}")
-    split_mp3(conv_path, folder_name)
+    split_mp3(conv_path, folder_name, slice_length)
     return folder_name
@@ -1,15 +1,37 @@
 from utils import download_video
 from exAudio import *
 from speech2text import *
+import speech2text
+from pipeline import run_pipeline, use_stream_pipeline
+import daemon
 
 # Main文件是作者用来测试的，请运行window.py
 
-av = input("请输入BV号：")
-filename = download_video(av[2:])
-foldername = process_audio_split(filename)
+if __name__ == "__main__":
+    av = input("请输入BV号：")
+    if daemon.is_running():
+        # 常驻转写服务已加载模型，直接提交任务
+        job = daemon.wait(daemon.submit(av[2:], model="small")["id"])
+        if job["status"] != "done":
+            print("转换失败！", job.get("error") or job["status"])
+            raise SystemExit(1)
+        print("转换完成！", job.get("output"))
+        raise SystemExit
+    if use_stream_pipeline():
+        load_whisper("small")
+        _, foldername = run_pipeline(av[2:], speech2text, prompt="以下是普通话的句子。", slice_length=preferred_slice_length())
+        print("转换完成！", f"outputs/{foldername}.md")
+        raise SystemExit
+    filename = download_video(av[2:])
+    slices = None
+    if use_in_memory_audio():
+        foldername, slices = process_audio_memory(filename, preferred_slice_length())
+    else:
+        foldername = process_audio_split(filename, preferred_slice_length())
 
 
-load_whisper("small")
-run_analysis(foldername, prompt="以下是普通话的句子。")
-output_path = f"outputs/{foldername}.md"
-print("转换完成！", output_path)
+    load_whisper("small")
+    run_analysis(foldername, prompt="以下是普通话的句子。", slices=slices,
+                 job_info={"file_id": filename, "link": av[2:], "slice_length": preferred_slice_length()})
+    output_path = f"outputs/{foldername}.md"
+    print("转换完成！", output_path)
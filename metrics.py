@@ -0,0 +1,129 @@
+"""
+结构化性能指标：记录下载、完整性校验、音频提取、切分、转写、润色等阶段的耗时、数据量、
+音频时长、实时率（RTF = 处理耗时 / 音频时长）、token 数和重试次数。
+每条记录追加写入 JSON Lines 文件（B2T_METRICS_FILE，默认 logs/metrics.jsonl；设置 B2T_METRICS=0 关闭）。
+设置 B2T_METRICS_PORT 后，首次记录时在本机启动 Prometheus 文本格式的 /metrics 接口，按阶段汇总累计值。
+"""
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 按阶段累加的字段，Prometheus 接口输出为 b2t_stage_<字段>_total
+SUMMED_FIELDS = ("seconds", "bytes", "audio_seconds", "tokens_in", "tokens_out", "retries")
+
+_lock = threading.Lock()
+_totals = {}  # stage -> {"runs", "errors", 各累加字段}
+_server = None
+_host = socket.gethostname()
+
+
+def enabled():
+    return str(os.getenv("B2T_METRICS", "1")).lower() not in ("0", "false", "no")
+
+
+def metrics_file():
+    return os.getenv("B2T_METRICS_FILE", os.path.join("logs", "metrics.jsonl"))
+
+
+def record(stage, seconds, **fields):
+    """
+    记录一次阶段执行。fields 中的 None 会被忽略；给出 audio_seconds 时自动计算实时率 rtf。
+    常用字段：bytes、audio_seconds、tokens_in、tokens_out、retries、error、backend、model。
+    """
+    if not enabled():
+        return
+    entry = {"ts": round(time.time(), 3), "host": _host, "pid": os.getpid(), "stage": stage, "seconds": round(seconds, 4)}
+    entry.update({k: v for k, v in fields.items() if v is not None})
+    if entry.get("audio_seconds"):
+        entry["rtf"] = round(seconds / entry["audio_seconds"], 4)
+    line = json.dumps(entry, ensure_ascii=False) + "\n"
+    with _lock:
+        totals = _totals.setdefault(stage, dict.fromkeys(("runs", "errors") + SUMMED_FIELDS, 0))
+        totals["runs"] += 1
+        totals["errors"] += 1 if entry.get("error") else 0
+        for field in SUMMED_FIELDS:
+            value = entry.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[field] += value
+        try:
+            path = metrics_file()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # 每条记录一次写入，多个进程同时追加时行也不会交错
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError:
+            pass
+    _ensure_server()
+
+
+@contextlib.contextmanager
+def timed(stage, **fields):
+    """
+    计时上下文：with timed("split") as m: ... ，在代码块中向 m 填入 bytes、audio_seconds 等字段。
+    代码块抛出异常时记录 error 字段并继续抛出。
+    """
+    data = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield data
+    except BaseException as e:
+        data.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, **data)
+
+
+def snapshot():
+    """返回各阶段累计值的副本"""
+    with _lock:
+        return {stage: dict(totals) for stage, totals in _totals.items()}
+
+
+def prometheus_text():
+    """按 Prometheus 文本格式输出各阶段累计值"""
+    lines = []
+    stats = snapshot()
+    for field in ("runs", "errors") + SUMMED_FIELDS:
+        name = f"b2t_stage_{field}_total"
+        lines.append(f"# TYPE {name} counter")
+        for stage, totals in sorted(stats.items()):
+            lines.append(f'{name}{{stage="{stage}",host="{_host}"}} {totals[field]}')
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _ensure_server():
+    global _server
+    port = os.getenv("B2T_METRICS_PORT")
+    if _server is not None or not port:
+        return
+    with _lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer((os.getenv("B2T_METRICS_HOST", "127.0.0.1"), int(port)), _Handler)
+        except OSError as e:
+            # 端口被占用（例如多进程转写的子进程）时不影响任务本身
+            _server = False
+            print(f"指标接口启动失败: {e}")
+            return
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
@@ -0,0 +1,339 @@
+"""
+流式处理管线：下载 → 解码 → 切片 → 转写 四个阶段同时运行，阶段之间用有界队列连接。
+切片一旦对应的音频可用就立即送去转写；下游处理不过来时队列写满，上游自动暂停（背压）。
+长视频的总耗时接近最慢的单个阶段，而不是各阶段耗时之和。
+"""
+import contextvars
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+import numpy as np
+import metrics
+from exAudio import SAMPLE_RATE, SpeechSegmenter, probe_media, read_stderr_tail, use_vad_slicing
+from utils import _detect_source, _download_lock, _download_video, _index_media, ensure_folders_exist, lookup_media
+
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "16"))  # 每个阶段之间最多缓存的数据块数
+CHUNK_BYTES = 256 * 1024  # 下载阶段每次转发的字节数
+PCM_CHUNK_SECONDS = 5  # 解码阶段每次转发的音频时长
+
+_END = object()  # 阶段结束标记
+
+
+def use_stream_pipeline():
+    """是否启用流式管线（STREAM_PIPELINE=1）"""
+    return str(os.getenv("STREAM_PIPELINE", "0")).lower() not in ("0", "false", "no")
+
+
+class _StageError:
+    """上游阶段的异常，沿队列传递到最终消费者后重新抛出"""
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def _stage(func):
+    """阶段线程的包装：异常转为 _StageError 传给下游，结束时总是发送结束标记"""
+    def run(out_q, stop, *args):
+        try:
+            func(out_q, stop, *args)
+        except Exception as e:
+            _put(out_q, _StageError(e), stop)
+        finally:
+            _put(out_q, _END, stop)
+    return run
+
+
+def _stream_with_ytdlp(out_q, stop, video_url, extra_headers, part_path):
+    """
+    yt-dlp 输出到标准输出，边下载边转发并写入 part_path。
+    返回成功下载的字节数，失败且无数据时为 0。
+    """
+    stderr = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen(
+            ["yt-dlp", "-o", "-", "--no-playlist", "-q", "-f", "ba[ext=m4a]/ba/b[ext=mp4]/b", *extra_headers, video_url],
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+    except FileNotFoundError:
+        stderr.close()
+        print("错误: 未找到yt-dlp命令。请先安装yt-dlp: pip install yt-dlp")
+        return 0
+    received = 0
+    try:
+        with open(part_path, "wb") as f:
+            while not stop.is_set():
+                chunk = proc.stdout.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+                _put(out_q, ("bytes", chunk), stop)
+        if stop.is_set():
+            proc.kill()
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        error = read_stderr_tail(stderr)
+        stderr.close()
+    if proc.returncode != 0 and not stop.is_set():
+        if received:
+            # 已经向下游发送了部分数据，无法无缝切换到其他下载方式
+            raise RuntimeError(f"yt-dlp流式下载中断: {error}")
+        os.remove(part_path)
+        return 0
+    return received
+
+
+def _container_ext(path):
+    """按文件头判断实际的容器格式并给出扩展名：管道下载的可能是 m4a、webm 或 mp4"""
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return ".webm"  # Matroska/WebM（通常为 opus 音频）
+    if head[:4] == b"OggS":
+        return ".ogg"
+    if head[:3] == b"FLV":
+        return ".flv"
+    if head[4:8] == b"ftyp":
+        try:
+            info = probe_media(path)
+        except ValueError:
+            info = None
+        if info is not None:
+            return ".mp4" if "video" in info["streams"] else ".m4a"
+        return ".m4a" if head[8:12] in (b"M4A ", b"dash") else ".mp4"
+    return ".mp4"
+
+
+@_stage
+def _download_stage(out_q, stop, source, file_id, video_url):
+    """下载阶段：本地已有完整文件时直接交给解码；否则 yt-dlp 输出到管道，边下载边转发并同时落盘"""
+    output_dir = f"bilibili_video/{file_id}"
+    ensure_folders_exist(output_dir)
+    with _download_lock(file_id):
+        existing = lookup_media(file_id, output_dir)
+        if existing:
+            print(f"已存在完整的视频文件，跳过下载: {existing}")
+            _put(out_q, ("path", existing), stop)
+            return
+        extra_headers = []
+        if source == "bilibili":
+            extra_headers = ["--referer", "https://www.bilibili.com", "--add-header", "User-Agent: Mozilla/5.0"]
+        part_path = os.path.join(output_dir, f"{file_id}.part")
+        print(f"使用yt-dlp流式下载: {video_url}")
+        with metrics.timed("download", source=source, mode="stream") as m:
+            received = _stream_with_ytdlp(out_q, stop, video_url, extra_headers, part_path)
+            m["bytes"] = received
+            m["ok"] = bool(received)
+        if stop.is_set():
+            return
+        if received:
+            output_path = os.path.join(output_dir, file_id + _container_ext(part_path))
+            os.replace(part_path, output_path)
+            _index_media(file_id, output_path)
+            print(f"视频已成功下载到: {output_path}")
+            _put(out_q, ("path", output_path), stop)
+            return
+        # 流式下载失败且尚未产出数据时，回退到完整下载（含B站直链下载）
+        print("流式下载失败，回退到完整下载...")
+        downloaded = _download_video(source, file_id, video_url)
+    if not downloaded:
+        raise RuntimeError("视频下载失败，无法继续处理。")
+    _put(out_q, ("path", downloaded), stop)
+
+
+def _ffmpeg_decode(out_q, stop, input_path, in_q=None, first=None):
+    """
+    运行 FFmpeg 解码并把 PCM 分块发往下游。input_path 为空时从 in_q 读取字节流写入 stdin。
+    返回 (产出的采样数, 下载阶段最终给出的完整文件路径)。
+    """
+    # 错误输出写入临时文件，损坏的数据产生大量错误信息时不会因管道写满而阻塞
+    stderr = tempfile.TemporaryFile()
+    proc = subprocess.Popen(
+        ['ffmpeg', '-nostdin', '-v', 'error', '-i', input_path or 'pipe:0',
+         '-vn', '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(SAMPLE_RATE), 'pipe:1'],
+        stdin=subprocess.DEVNULL if input_path else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+    )
+    state = {"error": None, "path": None}
+
+    def feed():
+        # 单独线程写入 stdin，避免与读取 stdout 互相阻塞
+        item = first
+        try:
+            while item is not _END:
+                if isinstance(item, _StageError):
+                    state["error"] = item.error
+                    break
+                kind, payload = item
+                if kind == "path":
+                    state["path"] = payload  # 下载完成，记录落盘的完整文件
+                    break
+                proc.stdin.write(payload)
+                item = _get(in_q, stop)
+        except OSError:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feeder = None
+    if not input_path:
+        feeder = threading.Thread(target=contextvars.copy_context().run, args=(feed,), daemon=True)
+        feeder.start()
+    produced = 0
+    chunk_bytes = SAMPLE_RATE * 2 * PCM_CHUNK_SECONDS
+    try:
+        while not stop.is_set():
+            data = proc.stdout.read(chunk_bytes)
+            if not data:
+                break
+            data = data[:len(data) // 2 * 2]
+            produced += len(data) // 2
+            _put(out_q, np.frombuffer(data, np.int16).astype(np.float32) / 32768.0, stop)
+        if stop.is_set():
+            proc.kill()
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if feeder is not None:
+            feeder.join()
+        error = read_stderr_tail(stderr)
+        stderr.close()
+    if state["error"] is not None:
+        raise state["error"]
+    if proc.returncode != 0 and not produced and not state["path"] and not stop.is_set():
+        raise RuntimeError(f"音频解码失败: {error}")
+    return produced, state["path"]
+
+
+@_stage
+def _decode_stage(out_q, stop, in_q):
+    """解码阶段：FFmpeg 将收到的媒体数据（或本地文件）解码为 16kHz 单声道 PCM"""
+    first = _get(in_q, stop)
+    if first is _END:
+        return
+    if isinstance(first, _StageError):
+        raise first.error
+    # 与下载同时进行，耗时包含等待上游数据的时间
+    with metrics.timed("decode", mode="stream") as m:
+        if first[0] == "path":
+            produced, _ = _ffmpeg_decode(out_q, stop, first[1])
+        else:
+            produced, completed_path = _ffmpeg_decode(out_q, stop, None, in_q, first)
+            if not produced and completed_path and not stop.is_set():
+                # 部分 MP4 的索引（moov）位于文件末尾，无法从管道解码，只能等下载完成后读取文件
+                print("媒体文件不支持流式解码，下载完成后从文件解码...")
+                produced, _ = _ffmpeg_decode(out_q, stop, completed_path)
+        m["audio_seconds"] = produced / SAMPLE_RATE
+
+
+@_stage
+def _slice_stage(out_q, stop, in_q, slice_length):
+    """切片阶段：流式语音活动检测，每确定一个切片就立即发往转写"""
+    segmenter = SpeechSegmenter(max_length=slice_length, vad=use_vad_slicing())
+    while True:
+        item = _get(in_q, stop)
+        if item is _END:
+            break
+        if isinstance(item, _StageError):
+            raise item.error
+        for audio_slice in segmenter.feed(item):
+            print(f"切片 {audio_slice['index']} 就绪: {audio_slice['start']:.1f}s - {audio_slice['end']:.1f}s")
+            _put(out_q, audio_slice, stop)
+    if not stop.is_set():
+        for audio_slice in segmenter.flush():
+            print(f"切片 {audio_slice['index']} 就绪: {audio_slice['start']:.1f}s - {audio_slice['end']:.1f}s")
+            _put(out_q, audio_slice, stop)
+
+
+def _forward_stop(source, stop):
+    """调用方的停止事件（界面/常驻服务的停止按钮）被设置时通知各阶段退出，下载或解码阶段也能立即停止"""
+    while not stop.is_set():
+        if source.wait(0.5):
+            stop.set()
+            return
+
+
+def _iter_slices(slice_q, stop):
+    while True:
+        item = _get(slice_q, stop)
+        if item is _END:
+            if stop.is_set():
+                # 各阶段是被停止的，不能当作正常结束，否则断点会被标记为已完成
+                print("任务已停止")
+                raise KeyboardInterrupt("用户请求停止任务")
+            return
+        if isinstance(item, _StageError):
+            raise item.error
+        yield item
+
+
+def run_pipeline(link_or_bv, speech_to_text, prompt=None, slice_length=45000):
+    """
+    以流式管线处理一个视频，转写结果与 run_analysis 一样保存到 outputs/<文件夹>.md 及字幕/JSON 文件。
+    参数:
+        link_or_bv: 视频链接或BV号
+        speech_to_text: 已加载模型的 speech2text 模块
+        prompt: 转写提示词，默认根据视频标识生成
+        slice_length: 单个切片的最大时长（毫秒）
+    返回:
+        (文件标识符, 文件夹名称)
+    """
+    source, file_id, video_url = _detect_source(str(link_or_bv))
+    folder_name = time.strftime('%Y%m%d%H%M%S')
+    if prompt is None:
+        prompt = "以下是普通话的句子。这是一个关于{}的视频。".format(file_id)
+    stop = threading.Event()
+    bytes_q, pcm_q, slice_q = (queue.Queue(maxsize=QUEUE_SIZE) for _ in range(3))
+    if getattr(speech_to_text, "stop_event", None) is not None:
+        threading.Thread(target=_forward_stop, args=(speech_to_text.stop_event, stop), daemon=True).start()
+    # 各阶段在复制的上下文中运行，常驻服务能把阶段日志归到当前任务
+    threads = [
+        threading.Thread(target=contextvars.copy_context().run, args=(func, out_q, stop, *args), daemon=True)
+        for func, out_q, args in (
+            (_download_stage, bytes_q, (source, file_id, video_url)),
+            (_decode_stage, pcm_q, (bytes_q,)),
+            (_slice_stage, slice_q, (pcm_q, slice_length)),
+        )
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        job_info = {"file_id": file_id, "link": str(link_or_bv), "slice_length": slice_length}
+        speech_to_text.run_analysis(folder_name, prompt=prompt, slices=_iter_slices(slice_q, stop), job_info=job_info)
+    finally:
+        # 正常结束、出错或用户停止时都通知各阶段退出
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return file_id, folder_name
@@ -0,0 +1,75 @@
+"""
+云端接口的限速与退避重试工具，供 Kimi 润色、OpenAI 转写、讯飞转写等共用。
+"""
+import random
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    按每分钟请求数（rpm）和每分钟 token 数（tpm）限速的令牌桶，线程安全。
+    任一限制为 0 表示不限制该项。
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens=0, stop_event=None):
+        """阻塞直到配额足够。stop_event 被设置时返回 False。"""
+        if self.tpm:
+            tokens = min(tokens, self.tpm)  # 单个请求超过整分钟配额时，等桶满即可发送
+        with self._cond:
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self.rpm and self._requests < 1:
+                        wait = (1 - self._requests) * 60.0 / self.rpm
+                    elif self.tpm and self._tokens < tokens:
+                        wait = (tokens - self._tokens) * 60.0 / self.tpm
+                    else:
+                        if self.rpm:
+                            self._requests -= 1
+                        if self.tpm:
+                            self._tokens -= tokens
+                        return True
+                self._cond.wait(min(wait, 0.5))
+
+    def pause(self, seconds):
+        """收到 429 等限流响应后，让所有调用方暂停一段时间"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """指数退避加全抖动（full jitter），避免多个请求同时重试"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after(response_or_error):
+    """从响应（或携带 response 的异常）的 Retry-After 头中读取需要等待的秒数"""
+    response = getattr(response_or_error, "response", response_or_error)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
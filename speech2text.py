@@ -1,33 +1,85 @@
-import whisper
 import os
 import ssl
-import certifi
 import sys
-import requests
 import json
+import re
+import collections
+import contextvars
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from dotenv import load_dotenv
-from openai import OpenAI
+import cache
+import checkpoint
+import metrics
+import transcript
+from ratelimit import RateLimiter, backoff_delay, retry_after
 
 # 加载.env文件
 load_dotenv()
 
-# 修复 SSL 证书验证问题 - 使用 certifi 提供的证书
-try:
-    ssl_context = ssl.create_default_context(cafile=certifi.where())
-    ssl._create_default_https_context = lambda: ssl_context
-except Exception:
-    # 如果 certifi 不可用，临时禁用验证（不推荐，但可以工作）
-    ssl._create_default_https_context = ssl._create_unverified_context
+_ssl_patched = False
+
+def _patch_ssl():
+    """修复 SSL 证书验证问题（Whisper 通过 urllib 下载模型时使用），在首次加载模型前执行一次"""
+    global _ssl_patched
+    if _ssl_patched:
+        return
+    _ssl_patched = True
+    # 使用 certifi 提供的证书
+    try:
+        import certifi
+        ssl_context = ssl.create_default_context(cafile=certifi.where())
+        ssl._create_default_https_context = lambda: ssl_context
+    except Exception:
+        # 如果 certifi 不可用，临时禁用验证（不推荐，但可以工作）
+        ssl._create_default_https_context = ssl._create_unverified_context
 
 # 禁用 tqdm 进度条以避免 GUI 环境中的线程问题
 os.environ['TQDM_DISABLE'] = '1'
 
 whisper_model = None
+whisper_model_name = None
+whisper_quantized = False  # 当前模型是否为 int8 动态量化版本
+_worker_pool = None  # 多进程转写时的进程池，每个 worker 各自持有一份模型
+_api_pool = None  # 云端转写时并发上传切片的线程池
+_openai_session = None  # 云端转写复用的长连接
 USE_OPENAI_API = bool(os.getenv("OPENAI_API_KEY")) and str(os.getenv("USE_OPENAI_WHISPER", "0")).lower() not in ("0", "false", "no")
 OPENAI_MODEL = os.getenv("OPENAI_WHISPER_MODEL", "whisper-1")
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
+OPENAI_MAX_CONCURRENCY = max(1, int(os.getenv("OPENAI_MAX_CONCURRENCY", "4")))  # 同时上传转写的切片数
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))  # 每分钟请求数上限，0 表示不限制
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))  # 429/5xx/网络错误时的重试次数
+OPENAI_UPLOAD_OPUS = str(os.getenv("OPENAI_UPLOAD_OPUS", "0")).lower() not in ("0", "false", "no")  # 上传前重新编码为低码率 Opus
 KIMI_API_KEY = os.getenv("KIMI_API_KEY")
 KIMI_API_BASE = os.getenv("KIMI_API_BASE", "https://api.moonshot.cn/v1")
 KIMI_MODEL = os.getenv("KIMI_MODEL", "moonshot-v1-32k")  # 默认使用 k1 32k 模型，侧重稳健校对
+WHISPER_BATCH_SIZE = max(1, int(os.getenv("WHISPER_BATCH_SIZE", "1")))  # 本地模型一次前向计算的切片数
+WHISPER_WORKERS = max(1, int(os.getenv("WHISPER_WORKERS", "1")))  # CPU 上并行转写的进程数
+WHISPER_THREADS_PER_WORKER = int(os.getenv("WHISPER_THREADS_PER_WORKER", "0"))  # 每个进程的 torch 线程数，0 表示按核数平分
+TIMESTAMP_PRECISION = 0.02  # Whisper 时间戳 token 的间隔（秒）
+WHISPER_QUANTIZE = str(os.getenv("WHISPER_QUANTIZE", "0")).lower() not in ("0", "false", "no")  # 仅 CPU：线性层 int8 动态量化
+WHISPER_QUANTIZED_DIR = os.getenv("WHISPER_QUANTIZED_DIR", os.path.join(cache.cache_dir(), "models"))  # 量化模型的磁盘缓存
+KIMI_MAX_CONCURRENCY = max(1, int(os.getenv("KIMI_MAX_CONCURRENCY", "4")))  # 同时进行的润色请求数
+KIMI_RPM = int(os.getenv("KIMI_RPM", "0"))  # 每分钟请求数上限，0 表示不限制
+KIMI_TPM = int(os.getenv("KIMI_TPM", "0"))  # 每分钟 token 数上限，0 表示不限制
+KIMI_MAX_RETRIES = int(os.getenv("KIMI_MAX_RETRIES", "4"))  # 429/5xx 时的重试次数
+KIMI_CHUNK_TOKENS = int(os.getenv("KIMI_CHUNK_TOKENS", "0"))  # 指定每块的 token 数，0 表示按模型自动选择
+KIMI_PARALLEL_CHUNKS = str(os.getenv("KIMI_PARALLEL_CHUNKS", "0")).lower() not in ("0", "false", "no")  # 切成更小的块以提高并行度
+KIMI_MIN_CHUNK_TOKENS = 2000  # 并行分块模式下每块的最小 token 数，避免块过碎影响上下文
+KIMI_TEMPERATURE = 0.15  # 降低随机性，避免过度创作
+KIMI_MAX_OUTPUT_TOKENS = 32000  # 单次请求的最大输出 tokens
+KIMI_TOKENIZER = os.getenv("KIMI_TOKENIZER", "cl100k_base")  # tiktoken 编码名称；设为 estimate 时使用估算
+KIMI_SYSTEM_PROMPT = (
+    "你是一个严格的中文转写润色助手。"
+    "请仅对给定文本进行错别字、标点、断句和轻微语气调整，"
+    "保持原始语序与信息完整，不新增总结、点评、延伸内容，"
+    "不改写成新的风格，也不要删除有效信息。"
+    "如果文本分块提供，也要保持上下文衔接。"
+    "输出与输入同一语种，并保持 Markdown 中的段落结构。"
+)
 
 # 停止事件（由外部设置）
 stop_event = None
@@ -37,25 +89,140 @@ def set_stop_event(event):
     global stop_event
     stop_event = event
 
-# 初始化 Kimi OpenAI 客户端
+openai_limiter = RateLimiter(rpm=OPENAI_RPM)
+
+# Kimi OpenAI 客户端在首次润色时创建，只转写不润色时不会导入 openai
 kimi_client = None
-if KIMI_API_KEY:
-    try:
-        kimi_client = OpenAI(
-            api_key=KIMI_API_KEY,
-            base_url=KIMI_API_BASE,
-        )
-    except Exception as e:
-        print(f"初始化 Kimi 客户端失败: {e}")
+_kimi_client_lock = threading.Lock()
+kimi_limiter = RateLimiter(rpm=KIMI_RPM, tpm=KIMI_TPM)
+
+def _get_kimi_client():
+    """返回 Kimi 客户端，未配置 KIMI_API_KEY 或初始化失败时返回 None"""
+    global kimi_client
+    with _kimi_client_lock:
+        if kimi_client is None and KIMI_API_KEY:
+            try:
+                from openai import OpenAI
+                kimi_client = OpenAI(
+                    api_key=KIMI_API_KEY,
+                    base_url=KIMI_API_BASE,
+                    max_retries=0,  # 由 _refine_chunk_with_retry 统一限速与重试
+                )
+            except Exception as e:
+                print(f"初始化 Kimi 客户端失败: {e}")
+        return kimi_client
 
 def is_cuda_available():
+    import whisper
     return whisper.torch.cuda.is_available()
 
+def _use_process_pool():
+    return WHISPER_WORKERS > 1 and not USE_OPENAI_API and not is_cuda_available()
+
+def _async_pool():
+    """返回异步转写使用的执行器：多进程转写池或云端上传线程池；同步转写时返回 None"""
+    global _api_pool
+    if USE_OPENAI_API:
+        if _api_pool is None:
+            _api_pool = ThreadPoolExecutor(max_workers=OPENAI_MAX_CONCURRENCY)
+        return _api_pool
+    return _worker_pool
+
+def _quantized_model_path(model):
+    """量化模型缓存文件：按模型名与 torch/whisper 版本区分，版本升级后自动重新量化"""
+    import whisper
+    name = os.path.splitext(os.path.basename(model))[0]
+    return os.path.join(WHISPER_QUANTIZED_DIR, f"whisper-{name}-int8-torch{whisper.torch.__version__}-whisper{whisper.__version__}.pt")
+
+def _quantize_model(model):
+    """线性层动态 int8 量化：权重预先量化，激活在推理时按批动态量化；卷积和词嵌入保持 fp32"""
+    import whisper
+    torch = whisper.torch
+    for module in model.modules():
+        # whisper 的 Linear 子类只在前向时把权重转换为输入精度，CPU fp32 下与 nn.Linear 等价；
+        # quantize_dynamic 只识别 nn.Linear 本身，先换回基类
+        if isinstance(module, torch.nn.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def _load_whisper_model(model, device):
+    """
+    加载 Whisper 模型，返回 (模型, 是否量化)。
+    CPU 上启用 WHISPER_QUANTIZE 时优先读取磁盘上的量化模型，没有缓存则加载 fp32 模型量化后写入缓存；
+    当前平台不支持量化时回退到 fp32。
+    """
+    import whisper
+    if not WHISPER_QUANTIZE or device != "cpu":
+        return whisper.load_model(model, device=device), False
+    torch = whisper.torch
+    path = _quantized_model_path(model)
+    if os.path.exists(path):
+        try:
+            return torch.load(path, map_location="cpu", weights_only=False), True
+        except Exception as e:
+            print(f"读取量化模型缓存失败（{e}），重新量化")
+    fp32_model = whisper.load_model(model, device="cpu")
+    try:
+        quantized = _quantize_model(fp32_model)
+    except Exception as e:
+        print(f"int8 量化失败（{e}），使用 fp32 模型")
+        return whisper.load_model(model, device="cpu"), False
+    os.makedirs(WHISPER_QUANTIZED_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(quantized, tmp_path)
+    os.replace(tmp_path, path)  # 多个进程同时量化时，后写入的整体替换，不会留下半截文件
+    print(f"量化模型已缓存: {path}")
+    return quantized, True
+
+def _pool_worker_init(model, threads):
+    """进程池 worker 初始化：固定 torch 线程预算，并且只加载一次模型"""
+    global whisper_model, whisper_model_name, whisper_quantized
+    import whisper
+    _patch_ssl()
+    whisper.torch.set_num_threads(threads)
+    whisper.torch.set_num_interop_threads(1)
+    whisper_model, whisper_quantized = _load_whisper_model(model, "cpu")
+    whisper_model_name = model
+
+def _pool_ping(_):
+    """预热任务：返回 worker 实际加载的模型是否为量化模型（读取缓存失败时可能回退到 fp32）"""
+    return whisper_quantized
+
+def _start_worker_pool(model):
+    """启动多进程转写池，避免多个进程的 intra-op 线程超额占用 CPU 核心"""
+    global _worker_pool, whisper_quantized
+    if _worker_pool is not None:
+        _worker_pool.shutdown(cancel_futures=True)
+    if WHISPER_QUANTIZE and not os.path.exists(_quantized_model_path(model)):
+        # 先在主进程中量化并写入缓存，避免每个 worker 各自量化一次
+        _patch_ssl()
+        _load_whisper_model(model, "cpu")
+    threads = WHISPER_THREADS_PER_WORKER or max(1, (os.cpu_count() or 1) // WHISPER_WORKERS)
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    _worker_pool = ProcessPoolExecutor(
+        max_workers=WHISPER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_pool_worker_init,
+        initargs=(model, threads),
+    )
+    # 预热：让所有 worker 在任务开始前完成模型加载；只有全部 worker 都加载了量化模型，才按 int8 后端记录缓存与断点
+    loaded = list(_worker_pool.map(_pool_ping, range(WHISPER_WORKERS)))
+    whisper_quantized = all(loaded)
+    if any(loaded) and not whisper_quantized:
+        print("部分转写进程未能加载量化模型，按 fp32 记录转写结果")
+    print(f"Whisper模型：{model}{'（int8 量化）' if whisper_quantized else ''}（{WHISPER_WORKERS} 个进程 × {threads} 线程）")
+
 def load_whisper(model="tiny"):
-    global whisper_model
+    global whisper_model, whisper_model_name, whisper_quantized
     if USE_OPENAI_API:
         print("检测到 OPENAI_API_KEY，启用云端 Whisper 转写，跳过本地模型加载。")
         return
+    whisper_model_name = model
+    if _use_process_pool():
+        _start_worker_pool(model)
+        return
+    _patch_ssl()
     # 彻底禁用 tqdm 以避免 GUI 环境中的线程问题
     import tqdm
     import tqdm._monitor
@@ -87,70 +254,396 @@ def load_whisper(model="tiny"):
         pass
     
     try:
-        whisper_model = whisper.load_model(model, device="cuda" if is_cuda_available() else "cpu")
-        print("Whisper模型："+model)
+        whisper_model, whisper_quantized = _load_whisper_model(model, "cuda" if is_cuda_available() else "cpu")
+        print("Whisper模型："+model+("（int8 量化）" if whisper_quantized else ""))
     finally:
         # 恢复原始 tqdm
         tqdm.tqdm = original_tqdm
         if original_monitor:
             tqdm._monitor.TMonitor = original_monitor
 
-def run_analysis(filename, model="tiny", prompt="以下是普通话的句子。"):
+def _list_slice_files(filename):
+    """按切片序号列出 audio/slice/<filename> 下的切片文件，并附带 slices.json 中记录的源音频偏移"""
+    slice_dir = f"audio/slice/{filename}"
+    offsets = {}
+    manifest_path = os.path.join(slice_dir, "slices.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            offsets = {item["file"]: item for item in json.load(f)}
+    audio_files = sorted(
+        [fn for fn in os.listdir(slice_dir) if os.path.splitext(fn)[0].isdigit()],
+        key=lambda x: int(os.path.splitext(x)[0])  # 按文件名数字排序
+    )
+    slices = []
+    for fn in audio_files:
+        audio_slice = {"index": int(os.path.splitext(fn)[0]), "path": f"{slice_dir}/{fn}"}
+        if fn in offsets:
+            audio_slice["start"] = offsets[fn]["start"]
+            audio_slice["end"] = offsets[fn]["end"]
+        slices.append(audio_slice)
+    return slices
+
+
+def preferred_slice_length():
+    """批量推理时切片需放进 Whisper 的单个 30 秒窗口，否则沿用 45 秒切片"""
+    return 30000 if WHISPER_BATCH_SIZE > 1 and not USE_OPENAI_API else 45000
+
+
+def _transcribe_slice(audio_slice, prompt):
+    """
+    转写单个切片。切片可以是文件路径（path）或内存中的 PCM 数组（audio）。
+    返回 {"text": 文本, "segments": [{"start", "end", "text"}, ...]}，时间相对切片起点。
+    """
+    audio = audio_slice.get("audio")
+    if USE_OPENAI_API:
+        path = audio_slice.get("path")
+        return _transcribe_via_openai(path, prompt, audio=None if path else audio)
+    result = whisper_model.transcribe(audio if audio is not None else audio_slice["path"], initial_prompt=prompt)
+    segments = [
+        {"start": seg["start"], "end": seg["end"], "text": seg["text"]}
+        for seg in result.get("segments", []) if seg is not None
+    ]
+    return {"text": "".join(seg["text"] for seg in segments), "segments": segments}
+
+
+def _transcribe_batch(audio_slices, prompt):
+    """
+    批量转写：将多个切片的梅尔频谱堆叠成一个 batch，一次完成编码器/解码器的前向计算。
+    仅适用于不超过 30 秒（Whisper 单个窗口）的切片，更长的切片回退到逐个转写。
+    返回与输入顺序一致的结果列表。
+    """
+    import whisper
+    results = [None] * len(audio_slices)
+    mels, positions, durations = [], [], []
+    for i, audio_slice in enumerate(audio_slices):
+        audio = audio_slice.get("audio")
+        if audio is None:
+            audio = whisper.load_audio(audio_slice["path"])
+        if len(audio) > whisper.audio.N_SAMPLES:
+            results[i] = _transcribe_slice(dict(audio_slice, audio=audio), prompt)
+            continue
+        mels.append(whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), whisper_model.dims.n_mels))
+        positions.append(i)
+        durations.append(len(audio) / whisper.audio.SAMPLE_RATE)
+    if mels:
+        mel = whisper.torch.stack(mels).to(whisper_model.device)
+        options = whisper.DecodingOptions(prompt=prompt, fp16=whisper_model.device.type == "cuda")
+        decoded = whisper.decode(whisper_model, mel, options)
+        tokenizer = whisper.tokenizer.get_tokenizer(
+            whisper_model.is_multilingual, num_languages=whisper_model.num_languages, task="transcribe")
+        for i, duration, result in zip(positions, durations, decoded):
+            # 与 transcribe 一致：判定为无语音的窗口不输出文本
+            if result.no_speech_prob > 0.6 and result.avg_logprob < -1.0:
+                results[i] = {"text": "", "segments": []}
+            else:
+                results[i] = {
+                    "text": result.text,
+                    "segments": _segments_from_tokens(result.tokens, tokenizer, duration, result.text),
+                }
+    return results
+
+
+def _segments_from_tokens(tokens, tokenizer, duration, text):
+    """
+    按解码结果中的时间戳 token（<|0.00|> 文本 <|2.40|><|2.40|> 文本 <|5.00|>）拆分出带时间的 segment，
+    时间相对切片起点。没有时间戳时整个切片作为一个 segment。
+    """
+    segments, pending, start = [], [], None
+    for token in tokens:
+        if token < tokenizer.timestamp_begin:
+            pending.append(token)
+            continue
+        time_offset = min((token - tokenizer.timestamp_begin) * TIMESTAMP_PRECISION, duration)
+        if pending and start is not None:
+            segments.append({"start": start, "end": time_offset, "text": tokenizer.decode(pending)})
+            pending, start = [], None
+        else:
+            start = time_offset
+    if pending:
+        segments.append({"start": start or 0.0, "end": duration, "text": tokenizer.decode(pending)})
+    segments = [seg for seg in segments if seg["text"].strip()]
+    if not segments and text:
+        segments = [{"start": 0.0, "end": duration, "text": text}]
+    return segments
+
+
+def _slice_cache_key(audio_slice, prompt, batched):
+    """
+    按切片音频、模型、提示词和解码选项计算转写缓存键，与视频来源（BV 号、文件夹）无关。
+    内存模式对解码后的 PCM 计算；文件模式直接对切片文件的字节计算，不为算键再调用一次 FFmpeg 解码。
+    """
+    audio = audio_slice.get("audio")
+    if audio is None:
+        with open(audio_slice["path"], "rb") as f:
+            return cache.make_key("transcript-file-v2", f.read(), _backend_name(), prompt, {"batched": batched})
+    import numpy as np
+    pcm = np.ascontiguousarray(audio, dtype=np.float32)
+    return cache.make_key("transcript-v2", memoryview(pcm), _backend_name(), prompt, {"batched": batched})
+
+
+def _backend_name():
+    """当前转写后端的标识，用于缓存键与断点校验"""
+    if USE_OPENAI_API:
+        return f"openai:{OPENAI_MODEL}{':opus' if OPENAI_UPLOAD_OPUS else ''}"
+    return f"whisper:{whisper_model_name}{':int8' if whisper_quantized else ''}"
+
+
+def _transcribe_slices(audio_slices, prompt):
+    """转写一批切片（单个切片走 transcribe，多个切片走批量解码）"""
+    if len(audio_slices) == 1:
+        return [_transcribe_slice(audio_slices[0], prompt)]
+    return _transcribe_batch(audio_slices, prompt)
+
+
+def _timed_transcribe_slices(audio_slices, prompt):
+    """转写一批切片并返回 (结果, 耗时)；在进程池子进程中只计时，指标由主进程统一记录"""
+    start = time.perf_counter()
+    results = _transcribe_slices(audio_slices, prompt)
+    return results, time.perf_counter() - start
+
+
+def _record_transcribe(audio_slices, seconds, error=None):
+    """记录一批切片的转写耗时与实时率"""
+    durations = [
+        len(s["audio"]) / 16000 if s.get("audio") is not None else s.get("end", 0) - s.get("start", 0)
+        for s in audio_slices
+    ]
+    metrics.record("transcribe", seconds, backend=_backend_name(), slices=len(audio_slices),
+                   audio_seconds=sum(durations) or None, error=error)
+
+
+def _wait_future(future):
+    """等待进程池任务完成，期间响应停止请求"""
+    while True:
+        if stop_event and stop_event.is_set():
+            raise KeyboardInterrupt("用户请求停止任务")
+        try:
+            return future.result(timeout=0.5)
+        except FuturesTimeoutError:
+            continue
+
+
+def _iter_results(slices, prompt, batch_size, done=None):
+    """
+    按切片顺序逐个产出 (切片, 转写结果)。
+    slices 可以是列表，也可以是流式管线中逐个到达的迭代器：每个切片先查断点 done 和缓存，
+    未命中的切片攒够 batch_size 个就交给模型；进程池或云端并发上传模式下提交后不等待，继续读取后续切片，
+    但同时在途的批次不超过并发数的两倍，达到上限时先等待最早的批次完成，不会把上游的切片一次性全部读入内存。
+    """
+    window = collections.deque()  # 尚未产出的切片，元素为 [切片, 缓存键, 结果, (future, 批内序号)]
+    batch = []
+    futures = set()  # 尚未取回结果的批次，中途退出时取消
+    max_in_flight = 2 * (OPENAI_MAX_CONCURRENCY if USE_OPENAI_API else WHISPER_WORKERS)
+    unrecorded = {}  # future -> 该批切片，结果取回时记录一次转写指标
+
+    def dispatch():
+        if not batch:
+            return
+        audio_slices = [entry[0] for entry in batch]
+        pool = _async_pool()
+        if pool is not None:
+            if USE_OPENAI_API:
+                # 上传线程沿用当前上下文（常驻服务据此把重试信息记入任务日志）
+                future = pool.submit(contextvars.copy_context().run, _timed_transcribe_slices, audio_slices, prompt)
+            else:
+                future = pool.submit(_timed_transcribe_slices, audio_slices, prompt)
+            futures.add(future)
+            unrecorded[future] = audio_slices
+            for k, entry in enumerate(batch):
+                entry[3] = (future, k)
+        else:
+            first, last = batch[0][0].get("index", "?"), batch[-1][0].get("index", "?")
+            if len(batch) == 1:
+                position = f" [{audio_slices[0]['start']:.1f}s]" if "start" in audio_slices[0] else ""
+                print(f"正在转换第{first}个音频... {audio_slices[0].get('path', '[内存]')}{position}")
+            else:
+                print(f"正在批量转换第{first}-{last}个音频（共{len(batch)}个）...")
+            start = time.perf_counter()
+            try:
+                results = _transcribe_slices(audio_slices, prompt)
+            except Exception as e:
+                _record_transcribe(audio_slices, time.perf_counter() - start, type(e).__name__)
+                raise
+            _record_transcribe(audio_slices, time.perf_counter() - start)
+            for entry, result in zip(batch, results):
+                entry[2] = result
+                if entry[1] is not None:
+                    cache.put("transcripts", entry[1], result)
+        batch.clear()
+
+    def drain(block):
+        while window:
+            entry = window[0]
+            if entry[2] is None:
+                if entry[3] is None:
+                    break  # 所在批次还没攒满
+                future, k = entry[3]
+                if not block and not future.done():
+                    break
+                results, seconds = _wait_future(future)
+                futures.discard(future)
+                if future in unrecorded:
+                    _record_transcribe(unrecorded.pop(future), seconds)
+                entry[2] = results[k]
+                if entry[1] is not None:
+                    cache.put("transcripts", entry[1], entry[2])
+            window.popleft()
+            yield entry[0], entry[2]
+
+    try:
+        for audio_slice in slices:
+            # 检查是否请求停止
+            if stop_event and stop_event.is_set():
+                print("任务已停止")
+                raise KeyboardInterrupt("用户请求停止任务")
+            record = (done or {}).get(audio_slice.get("index"))
+            if record is not None and checkpoint.matches(record, audio_slice):
+                # 断点中已完成的切片不再计算缓存键，文件模式下也无需解码
+                window.append([dict(audio_slice, resumed=True), None, record["result"], None])
+                yield from drain(block=False)
+                continue
+            key = _slice_cache_key(audio_slice, prompt, batch_size > 1) if cache.enabled() else None
+            result = cache.get("transcripts", key) if key else None
+            if result is not None:
+                audio_slice = dict(audio_slice, cached=True)
+            entry = [audio_slice, key, result, None]
+            window.append(entry)
+            if result is None:
+                batch.append(entry)
+                if len(batch) >= batch_size:
+                    dispatch()
+            yield from drain(block=False)
+            while len(futures) >= max_in_flight:
+                # 在途批次达到上限：等最早的批次完成并产出结果后再读取下一个切片
+                _wait_future(next(entry[3][0] for entry in window if entry[2] is None and entry[3] is not None))
+                yield from drain(block=False)
+        dispatch()
+        yield from drain(block=True)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def run_analysis(filename, model="tiny", prompt="以下是普通话的句子。", slices=None, batch_size=None, job_info=None,
+                 resume=False):
     """
     执行语音转文字分析，生成原始转写文档（不进行AI润色）。
+    每个切片完成后立即追加到 outputs/<filename>.md 及 SRT/VTT 字幕，全部完成后导出带时间戳的 JSON；
+    同时写入断点 checkpoints/<filename>.jsonl，同一文件夹再次执行时跳过已完成的切片。
     参数:
         filename: 音频文件夹名称
         model: Whisper模型名称（未使用，保留兼容性）
         prompt: 转写提示词
+        slices: 可选，内存模式下由 exAudio.process_audio_memory 返回的切片列表，
+                或流式管线（pipeline.run_pipeline）逐个产出切片的迭代器；
+                为空时读取 audio/slice/<filename> 下的切片文件
+        batch_size: 本地模型每批转写的切片数，默认取 WHISPER_BATCH_SIZE
+        job_info: 可选，{"file_id", "link", "slice_length"}，记录到断点中，供 resume_analysis 重新生成切片
+        resume: 是否为从断点继续；此时断点与当前设置不一致会报错，而不是清空断点重新开始
     返回:
         原始转写文本
     """
     global whisper_model
     print("正在加载Whisper模型或准备API...")
+    mode = "files" if slices is None else "memory"
     # 读取列表中的音频文件
-    audio_list = os.listdir(f"audio/slice/{filename}")
+    if slices is None:
+        slices = _list_slice_files(filename)
     print("模型准备完成！")
-    # 添加排序逻辑
-    audio_files = sorted(
-        audio_list,
-        key=lambda x: int(os.path.splitext(x)[0])  # 按文件名数字排序
-    )
     # 创建outputs文件夹
     os.makedirs("outputs", exist_ok=True)
     print("正在转换文本...")
 
-    audio_list.sort(key=lambda x: int(x.split(".")[0])) # 将 audio_list 按照切片序号排序
-
-    texts = []
-    for idx, fn in enumerate(audio_files, start=1):
-        # 检查是否请求停止
-        if stop_event and stop_event.is_set():
-            print("任务已停止")
-            raise KeyboardInterrupt("用户请求停止任务")
-        
-        print(f"正在转换第{idx}/{len(audio_files)}个音频... {fn}")
-        slice_path = f"audio/slice/{filename}/{fn}"
-        if USE_OPENAI_API:
-            text = _transcribe_via_openai(slice_path, prompt)
-        else:
-            result = whisper_model.transcribe(slice_path, initial_prompt=prompt)
-            text = "".join([seg["text"] for seg in result.get("segments", []) if seg is not None])
-        print(text)
-        texts.append(text)
+    done = checkpoint.begin(filename, resume=resume, prompt=prompt, backend=_backend_name(), mode=mode, **(job_info or {}))
+    if done:
+        print(f"从断点继续：已完成 {len(done)} 个切片")
+    batch_size = 1 if USE_OPENAI_API else (batch_size or WHISPER_BATCH_SIZE)
+    total = f"/{len(slices)}" if hasattr(slices, "__len__") else ""
+    writer = transcript.TranscriptWriter(filename)
+    hits = 0
+    resumed = 0
+    results = _iter_results(slices, prompt, batch_size, done)
+    try:
+        for idx, (audio_slice, result) in enumerate(results, start=1):
+            writer.add(audio_slice, result)
+            if audio_slice.get("resumed"):
+                resumed += 1
+                continue
+            if audio_slice.get("cached"):
+                hits += 1
+                print(f"第{idx}{total}个音频命中缓存")
+            elif _async_pool() is not None:
+                print(f"第{idx}{total}个音频转换完成")
+            print(result["text"])
+            checkpoint.add_slice(filename, audio_slice, result)
+    finally:
+        results.close()
+        writer.close()
+    if resumed:
+        print(f"跳过断点中已完成的 {resumed}/{len(writer.texts)} 个切片")
+    if hits:
+        print(f"转写缓存命中 {hits}/{len(writer.texts)} 个切片")
 
-    raw_text = "\n".join(texts)
-    
     # 只保存原始转写结果
-    output_path = f"outputs/{filename}.md"
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write("# 转写结果（原始）\n\n")
-        f.write(raw_text.strip())
-        f.write("\n")
-    print(f"原始转写结果已保存为 Markdown: {output_path}")
-    
+    raw_text = writer.finish()
+    checkpoint.finish(filename)
     return raw_text
 
 
+def resume_analysis(filename, prompt=None):
+    """
+    从断点继续转写 run_analysis 中断的任务，只转写尚未完成的切片。
+    文件模式直接读取 audio/slice/<filename>；内存/流式模式按断点中的视频标识重新解码（视频不存在时重新下载）。
+    当前加载的本地模型与断点中记录的不同时，自动切换到断点使用的模型；无法切换（云端/本地、量化设置不同）时报错。
+    """
+    state = checkpoint.load(filename)
+    if state is None:
+        raise FileNotFoundError(f"没有找到断点: {checkpoint.path(filename)}")
+    job = state["job"]
+    if not state["finished"] and job.get("backend") != _backend_name():
+        model = _whisper_model_of(job.get("backend"))
+        if model and not USE_OPENAI_API and model != whisper_model_name:
+            print(f"断点使用 {model} 模型转写，切换到该模型继续")
+            load_whisper(model)
+        if job.get("backend") != _backend_name():
+            raise RuntimeError(f"断点使用的转写后端为 {job.get('backend')}，当前为 {_backend_name()}，"
+                               "请使用相同的模型与设置继续，或重新转写")
+    if state["finished"]:
+        print("该任务已完成，直接根据断点重新生成文档")
+        writer = transcript.TranscriptWriter(filename)
+        for record in sorted(state["slices"].values(), key=lambda r: r["index"]):
+            writer.add(record, record["result"])
+        return writer.finish()
+    job_info = {k: job[k] for k in ("file_id", "link", "slice_length") if job.get(k) is not None}
+    slices = None
+    if job.get("mode") != "files":
+        from exAudio import find_video_file, process_audio_memory
+        file_id = job.get("file_id")
+        if not file_id:
+            raise RuntimeError("断点中没有记录视频标识，无法重新生成切片")
+        try:
+            find_video_file(file_id)
+        except FileNotFoundError:
+            from utils import download_video
+            print("视频文件不存在，重新下载...")
+            if download_video(job.get("link") or file_id) is None:
+                raise RuntimeError("视频下载失败，无法继续转写")
+        _, slices = process_audio_memory(file_id, job.get("slice_length") or preferred_slice_length())
+    return run_analysis(filename, prompt=prompt or job["prompt"], slices=slices, job_info=job_info, resume=True)
+
+
+def _whisper_model_of(backend):
+    """从后端标识（如 whisper:small:int8）中取出本地模型名称，云端后端返回 None"""
+    parts = (backend or "").split(":")
+    return parts[1] if parts[0] == "whisper" and len(parts) > 1 else None
+
+
+def resume_model(filename):
+    """断点中记录的本地 Whisper 模型名称；没有断点或使用云端转写时返回 None"""
+    state = checkpoint.load(filename)
+    return _whisper_model_of(state["job"].get("backend")) if state else None
+
+
 def refine_text(filename, prompt="以下是普通话的句子。"):
     """
     对已生成的原始转写文档进行AI润色，生成新的润色文档。
@@ -163,7 +656,7 @@ def refine_text(filename, prompt="以下是普通话的句子。"):
     if not KIMI_API_KEY:
         raise RuntimeError("未配置 KIMI_API_KEY，无法进行AI润色。请在.env文件中配置。")
     
-    if not kimi_client:
+    if not _get_kimi_client():
         raise RuntimeError("Kimi 客户端未初始化，请检查 KIMI_API_KEY 配置是否正确。")
     
     # 读取原始转写文档
@@ -207,32 +700,122 @@ def refine_text(filename, prompt="以下是普通话的句子。"):
         raise
 
 
-def _transcribe_via_openai(file_path: str, prompt: str) -> str:
-    """使用 OpenAI Whisper API 进行转写，加速 CPU 设备的处理。"""
+def _get_openai_session():
+    """云端转写共用的 HTTP 会话，保持长连接，连接池容量与并发数一致"""
+    global _openai_session
+    if _openai_session is None:
+        import requests
+        _openai_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(OPENAI_MAX_CONCURRENCY, 10))
+        _openai_session.mount("https://", adapter)
+        _openai_session.mount("http://", adapter)
+    return _openai_session
+
+
+def _openai_upload_file(file_path, audio=None):
+    """准备上传的文件：按配置重新编码为 Opus，否则内存切片编码为 WAV、文件切片原样上传"""
+    if OPENAI_UPLOAD_OPUS:
+        from exAudio import encode_opus
+        return ("slice.ogg", encode_opus(file_path, audio), "audio/ogg")
+    if audio is not None:
+        from exAudio import array_to_wav_bytes
+        return ("slice.wav", array_to_wav_bytes(audio), "audio/wav")
+    with open(file_path, "rb") as f:
+        return (os.path.basename(file_path), f.read(), "audio/mpeg")
+
+
+def _transcribe_via_openai(file_path: str, prompt: str, audio=None) -> dict:
+    """
+    使用 OpenAI Whisper API 进行转写，加速 CPU 设备的处理。
+    所有请求共用长连接与限速器；429/5xx/网络错误时按 Retry-After 或指数退避加抖动重试。
+    whisper 系列模型请求 verbose_json 以获得 segment 时间戳；其他模型（如 gpt-4o-transcribe）只返回文本。
+    返回 {"text": 文本, "segments": [{"start", "end", "text"}, ...]}。
+    """
+    import requests
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("缺少 OPENAI_API_KEY，无法使用云端转写。")
     headers = {"Authorization": f"Bearer {api_key}"}
-    with open(file_path, "rb") as f:
-        files = {"file": (os.path.basename(file_path), f, "audio/mpeg")}
-        data = {"model": OPENAI_MODEL, "prompt": prompt}
-        resp = requests.post("https://api.openai.com/v1/audio/transcriptions", headers=headers, data=data, files=files, timeout=300)
-    if not resp.ok:
-        raise RuntimeError(f"OpenAI 转写失败: {resp.status_code} {resp.text}")
-    return resp.json().get("text", "")
+    data = {"model": OPENAI_MODEL, "prompt": prompt}
+    if OPENAI_MODEL.startswith("whisper"):
+        data["response_format"] = "verbose_json"
+    upload = _openai_upload_file(file_path, audio)  # 只编码一次，重试时复用
+    url = OPENAI_API_BASE.rstrip("/") + "/audio/transcriptions"
+    with metrics.timed("openai_request", model=OPENAI_MODEL, bytes=len(upload[1])) as m:
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            m["retries"] = attempt
+            if not openai_limiter.acquire(stop_event=stop_event):
+                raise KeyboardInterrupt("用户请求停止任务")
+            try:
+                resp = _get_openai_session().post(url, headers=headers, data=data, files={"file": upload}, timeout=300)
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if resp.ok:
+                    body = resp.json()
+                    segments = [
+                        {"start": seg["start"], "end": seg["end"], "text": seg["text"]}
+                        for seg in body.get("segments") or []
+                    ]
+                    return {"text": body.get("text", ""), "segments": segments}
+                if resp.status_code != 429 and resp.status_code < 500:
+                    raise RuntimeError(f"OpenAI 转写失败: {resp.status_code} {resp.text}")
+                error = f"{resp.status_code} {resp.text[:200]}"
+                wait = retry_after(resp)
+                if wait:
+                    openai_limiter.pause(wait)
+            if attempt < OPENAI_MAX_RETRIES:
+                print(f"OpenAI 转写请求失败，稍后重试（第{attempt + 1}次）: {error}")
+                time.sleep(backoff_delay(attempt))
+        raise RuntimeError(f"OpenAI 转写失败: {error}")
 
 
-def _estimate_tokens(text: str) -> int:
+_token_encoder = None  # tiktoken 编码器，不可用时为 False
+
+
+def _get_token_encoder():
+    """按需加载 tiktoken 编码器；未安装或编码文件无法获取时回退到估算"""
+    global _token_encoder
+    if _token_encoder is None:
+        _token_encoder = False
+        if KIMI_TOKENIZER != "estimate":
+            try:
+                import tiktoken
+                _token_encoder = tiktoken.get_encoding(KIMI_TOKENIZER)
+            except Exception as e:
+                print(f"tiktoken 不可用（{e}），改用估算方式统计 token")
+    return _token_encoder
+
+
+_NON_CJK_RE = re.compile(r"[^\u4e00-\u9fff]+")
+
+
+def _estimate_tokens(text: str, fractional=False):
     """
-    估算文本的 token 数量。
+    估算文本的 token 数量（tiktoken 不可用时的回退方案）。
     中文大约 1.5 字符 = 1 token，英文大约 4 字符 = 1 token。
-    这里使用一个简单的估算：中文字符按 1.5 计算，其他字符按 4 计算。
+    用正则一次性剔除非中文字符来统计中文字符，不逐字符循环。fractional 为 True 时不取整。
     """
-    chinese_chars = sum(1 for c in text if '\u4e00' <= c <= '\u9fff')
+    chinese_chars = len(_NON_CJK_RE.sub("", text))
     other_chars = len(text) - chinese_chars
     # 中文字符按 1.5 字符/token，其他按 4 字符/token
-    estimated_tokens = int(chinese_chars / 1.5 + other_chars / 4)
-    return estimated_tokens
+    estimated_tokens = chinese_chars / 1.5 + other_chars / 4
+    return estimated_tokens if fractional else int(estimated_tokens)
+
+
+def _count_tokens_batch(texts: list, fractional=False) -> list:
+    """
+    批量统计 token 数，优先使用 tiktoken 精确计数。
+    fractional 为 True 时估算值不取整，逐句累加不会因为每句都向下取整而低估整块的长度。
+    """
+    encoder = _get_token_encoder()
+    if encoder:
+        return [len(tokens) for tokens in encoder.encode_ordinary_batch(texts)]
+    return [_estimate_tokens(text, fractional) for text in texts]
+
+
+def _count_tokens(text: str) -> int:
+    return _count_tokens_batch([text])[0]
 
 
 def _get_model_max_tokens(model_name: str) -> int:
@@ -251,141 +834,197 @@ def _get_model_max_tokens(model_name: str) -> int:
         return 256000
 
 
+# 句末标点（含中英文、分号、省略号与随后的引号/括号）或换行处都可以作为分块边界
+# 句末：中文/全角标点、英文 !?; 以及后面跟空白的英文句点（不会切开 3.14 之类的数字）
+_SENTENCE_RE = re.compile(r'(?:[^。！？!?；;…\n.]|\.(?!\s))*(?:(?:[。！？!?；;…]+|\.(?=\s))[”’"」』）)\]]*|\n|$)')
+_CLAUSE_RE = re.compile(r'[^，,、\s]*(?:[，,、\s]+|$)')
+
+
 def _split_text_into_chunks(text: str, max_tokens_per_chunk: int) -> list:
     """
     将文本分割成多个块，每块不超过指定的 token 数量。
-    尽量在段落边界（换行符）处分割，保持语义完整性。
+    先按句末标点和换行切成句子，批量计数后一次遍历贪心装箱，尽量让每块接近上限。
+    单个句子超过上限时按字符比例再切开。装好的块再整体计数一次，超过上限的块对半拆开。
     """
-    # 估算每块的最大字符数（保守估计，假设全是中文）
-    max_chars_per_chunk = int(max_tokens_per_chunk * 1.5)
-    
-    chunks = []
-    paragraphs = text.split('\n')
-    current_chunk = []
-    current_length = 0
-    
-    for para in paragraphs:
-        para_length = len(para)
-        # 如果单个段落就超过限制，需要进一步分割
-        if para_length > max_chars_per_chunk:
-            # 先保存当前块
-            if current_chunk:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = []
-                current_length = 0
-            
-            # 将长段落按句子分割
-            sentences = para.split('。')
-            for sent in sentences:
-                sent = sent.strip()
-                if not sent:
-                    continue
-                sent_length = len(sent)
-                if current_length + sent_length + 1 > max_chars_per_chunk:
-                    if current_chunk:
-                        chunks.append('\n'.join(current_chunk))
-                    current_chunk = [sent]
-                    current_length = sent_length
-                else:
-                    current_chunk.append(sent)
-                    current_length += sent_length + 1
-        else:
-            # 检查添加这个段落后是否超过限制
-            if current_length + para_length + 1 > max_chars_per_chunk:
-                if current_chunk:
-                    chunks.append('\n'.join(current_chunk))
-                current_chunk = [para]
-                current_length = para_length
-            else:
-                current_chunk.append(para)
-                current_length += para_length + 1
+    sentences = [m.group(0) for m in _SENTENCE_RE.finditer(text) if m.group(0)]
+    counts = _count_tokens_batch(sentences, fractional=True)
     
-    # 添加最后一个块
-    if current_chunk:
-        chunks.append('\n'.join(current_chunk))
+    units = []
+    for sent, count in zip(sentences, counts):
+        if count <= max_tokens_per_chunk:
+            units.append((sent, count))
+            continue
+        # 超长句子先在逗号、顿号、空白处切开，仍然超长的片段按平均每 token 字符数切开
+        clauses = [m.group(0) for m in _CLAUSE_RE.finditer(sent) if m.group(0)]
+        for clause, clause_count in zip(clauses, _count_tokens_batch(clauses, fractional=True)):
+            if clause_count <= max_tokens_per_chunk:
+                units.append((clause, clause_count))
+                continue
+            piece_len = max(1, int(len(clause) * max_tokens_per_chunk / clause_count * 0.95))
+            pieces = [clause[i:i + piece_len] for i in range(0, len(clause), piece_len)]
+            units.extend(zip(pieces, _count_tokens_batch(pieces, fractional=True)))
     
+    groups = []
+    current, current_tokens = [], 0
+    for unit, count in units:
+        if current and current_tokens + count > max_tokens_per_chunk:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(unit)
+        current_tokens += count
+    if current:
+        groups.append(current)
+
+    # 逐句计数之和与整块计数可能不同（分词跨越句子边界），整块超过上限时对半拆开
+    def fit(group, count=None):
+        chunk = ''.join(group).strip()
+        if count is None:
+            count = _count_tokens(chunk)
+        if count > max_tokens_per_chunk and len(group) > 1:
+            return fit(group[:len(group) // 2]) + fit(group[len(group) // 2:])
+        return [chunk] if chunk else []
+
+    joined = [''.join(group).strip() for group in groups]
+    chunks = []
+    for group, count in zip(groups, _count_tokens_batch(joined)):
+        chunks.extend(fit(group, count))
     return chunks
 
 
+def _prompt_overhead_tokens(prompt: str) -> int:
+    """系统提示、主题提示和消息模板占用的 token 数（含少量消息格式开销）"""
+    return _count_tokens(KIMI_SYSTEM_PROMPT) + _count_tokens(prompt) + 100
+
+
 def _refine_with_kimi(text: str, prompt: str) -> str:
     """调用 Kimi (Moonshot) 进行润色/纠错。支持长文本自动分块处理。"""
     # 获取模型的最大 token 限制
     max_tokens = _get_model_max_tokens(KIMI_MODEL)
-    # 估算 prompt 和 system message 的 token（约 200-300 tokens）
-    prompt_tokens = _estimate_tokens(prompt) + 300
-    # 根据模型大小动态调整每块的最大 token 数（为 prompt 和响应预留空间）
-    if max_tokens >= 256000:
-        max_text_tokens_per_chunk = 200000  # 256k 模型（k2 thinking）
-    elif max_tokens >= 128000:
-        max_text_tokens_per_chunk = 100000   # 128k 模型
-    elif max_tokens >= 32000:
-        max_text_tokens_per_chunk = 25000    # 32k 模型
-    else:
-        max_text_tokens_per_chunk = 5500     # 8k 模型（保守估计）
+    prompt_tokens = _prompt_overhead_tokens(prompt)
+    # 润色输出与输入长度相近，且输入与输出共用上下文窗口：每块文本最多占去掉提示词后的一半，
+    # 同时不超过单次请求的输出上限，否则输出会被截断
+    max_text_tokens_per_chunk = min(KIMI_MAX_OUTPUT_TOKENS, (max_tokens - prompt_tokens) // 2)
+    
+    if KIMI_CHUNK_TOKENS:
+        max_text_tokens_per_chunk = min(max_text_tokens_per_chunk, KIMI_CHUNK_TOKENS)
     
-    # 估算整个文本的 token 数量
-    total_tokens = _estimate_tokens(text)
+    # 统计整个文本的 token 数量
+    total_tokens = _count_tokens(text)
     
-    print(f"文档总长度约 {total_tokens} tokens，模型限制 {max_tokens} tokens")
+    print(f"文档总长度 {total_tokens} tokens，模型限制 {max_tokens} tokens")
     
-    # 对于 k2 模型（256k），大多数文档都可以一次性处理
-    if total_tokens + prompt_tokens <= max_tokens:
-        if total_tokens <= max_text_tokens_per_chunk:
-            print("文档长度在模型限制内，直接处理...")
-            return _refine_single_chunk(text, prompt)
+    if KIMI_PARALLEL_CHUNKS:
+        # 按并发数均分文档，让每个并发请求都有活干
+        parallel_chunk_tokens = max(KIMI_MIN_CHUNK_TOKENS, math.ceil(total_tokens / KIMI_MAX_CONCURRENCY))
+        max_text_tokens_per_chunk = min(max_text_tokens_per_chunk, parallel_chunk_tokens)
+    
+    if total_tokens <= max_text_tokens_per_chunk:
+        print("文档长度在模型限制内，直接处理...")
+        cached = cache.get("refine", _refine_cache_key(text, prompt))
+        if cached is not None:
+            print("命中润色缓存，跳过 API 调用")
+            return cached
+        return _refine_chunk_with_retry(text, prompt)
     
     # 需要分块处理（对于超长文档）
     print(f"文档较长，将分块处理（每块文本约 {max_text_tokens_per_chunk} tokens）...")
     chunks = _split_text_into_chunks(text, max_text_tokens_per_chunk)
-    print(f"共分为 {len(chunks)} 块进行润色")
+    workers = min(KIMI_MAX_CONCURRENCY, len(chunks))
+    print(f"共分为 {len(chunks)} 块进行润色（并发 {workers}）")
     
-    refined_chunks = []
-    for idx, chunk in enumerate(chunks, 1):
-        # 检查是否请求停止
-        if stop_event and stop_event.is_set():
-            print("任务已停止")
-            # 将已处理的块和未处理的块合并
-            if refined_chunks:
-                return '\n\n'.join(refined_chunks) + '\n\n[任务已停止，以下内容未润色]\n\n' + '\n\n'.join(chunks[idx-1:])
-            else:
-                raise KeyboardInterrupt("用户请求停止任务")
-        
-        chunk_tokens = _estimate_tokens(chunk)
-        print(f"正在润色第 {idx}/{len(chunks)} 块（约 {chunk_tokens} tokens）...")
+    cached_chunks = [cache.get("refine", _refine_cache_key(chunk, prompt)) for chunk in chunks]
+    hits = sum(1 for c in cached_chunks if c is not None)
+    if hits:
+        print(f"润色缓存命中 {hits}/{len(chunks)} 块，仅新增或修改的块会调用 API")
+    
+    def refine_chunk(idx, chunk):
+        if cached_chunks[idx - 1] is not None:
+            return cached_chunks[idx - 1]
+        print(f"正在润色第 {idx}/{len(chunks)} 块（{_count_tokens(chunk)} tokens）...")
         try:
-            refined_chunk = _refine_single_chunk(chunk, prompt)
-            refined_chunks.append(refined_chunk)
+            refined_chunk = _refine_chunk_with_retry(chunk, prompt)
+            print(f"第 {idx}/{len(chunks)} 块润色完成")
+            return refined_chunk
         except KeyboardInterrupt:
             raise  # 重新抛出停止请求
         except Exception as e:
             print(f"第 {idx} 块润色失败: {e}，保留原文")
-            refined_chunks.append(chunk)  # 失败时保留原文
+            return chunk  # 失败时保留原文
+    
+    refined_chunks = []
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [pool.submit(contextvars.copy_context().run, refine_chunk, idx, chunk) for idx, chunk in enumerate(chunks, 1)]
+    try:
+        # 按原顺序收集结果
+        for future in futures:
+            while True:
+                if stop_event and stop_event.is_set():
+                    raise KeyboardInterrupt("用户请求停止任务")
+                try:
+                    refined_chunks.append(future.result(timeout=0.5))
+                    break
+                except FuturesTimeoutError:
+                    continue
+    except KeyboardInterrupt:
+        print("任务已停止")
+        # 将已处理的块和未处理的块合并
+        if refined_chunks:
+            return '\n\n'.join(refined_chunks) + '\n\n[任务已停止，以下内容未润色]\n\n' + '\n\n'.join(chunks[len(refined_chunks):])
+        raise
+    finally:
+        # 停止时不等待仍在进行中的请求
+        pool.shutdown(wait=False, cancel_futures=True)
     
     # 合并所有润色后的块
     print("所有块润色完成，正在合并结果...")
     return '\n\n'.join(refined_chunks)
 
 
+def _refine_cache_key(text: str, prompt: str) -> str:
+    """润色缓存键：块文本、提示词、模型、系统提示与温度任一变化都会重新请求"""
+    return cache.make_key("refine-v1", text, prompt, KIMI_MODEL, KIMI_SYSTEM_PROMPT, KIMI_TEMPERATURE)
+
+
+def _refine_chunk_with_retry(text: str, prompt: str) -> str:
+    """按 RPM/TPM 配额发送润色请求，遇到 429 或 5xx 时指数退避重试。成功的结果写入润色缓存。"""
+    # 输入和输出都计入 TPM，润色的输出长度与输入相近
+    text_tokens = _count_tokens(text)
+    tokens = _prompt_overhead_tokens(prompt) + text_tokens * 2
+    with metrics.timed("refine_chunk", model=KIMI_MODEL, tokens_in=text_tokens) as m:
+        for attempt in range(KIMI_MAX_RETRIES + 1):
+            m["retries"] = attempt
+            if not kimi_limiter.acquire(tokens, stop_event):
+                raise KeyboardInterrupt("用户请求停止任务")
+            try:
+                refined = _refine_single_chunk(text, prompt)
+                cache.put("refine", _refine_cache_key(text, prompt), refined)
+                m["tokens_out"] = _count_tokens(refined)
+                return refined
+            except RuntimeError as e:
+                status = getattr(e.__cause__, "status_code", None)
+                if attempt >= KIMI_MAX_RETRIES or not (status == 429 or (status or 0) >= 500):
+                    raise
+                delay = retry_after(e.__cause__) or backoff_delay(attempt)
+                if status == 429:
+                    kimi_limiter.pause(delay)  # 限流时所有并发请求一起暂停
+                print(f"Kimi 返回 {status}，{delay:.1f} 秒后重试（第 {attempt + 1}/{KIMI_MAX_RETRIES} 次）")
+                time.sleep(delay)
+
+
 def _refine_single_chunk(text: str, prompt: str) -> str:
     """对单个文本块调用 Kimi API 进行润色。使用 OpenAI 兼容客户端。"""
-    if not kimi_client:
+    client = _get_kimi_client()
+    if not client:
         raise RuntimeError("Kimi 客户端未初始化，请检查 KIMI_API_KEY 配置。")
     
     try:
         # 使用 OpenAI 兼容客户端调用 Kimi API
-        response = kimi_client.chat.completions.create(
+        response = client.chat.completions.create(
             model=KIMI_MODEL,
             messages=[
                 {
                     "role": "system",
-                    "content": (
-                        "你是一个严格的中文转写润色助手。"
-                        "请仅对给定文本进行错别字、标点、断句和轻微语气调整，"
-                        "保持原始语序与信息完整，不新增总结、点评、延伸内容，"
-                        "不改写成新的风格，也不要删除有效信息。"
-                        "如果文本分块提供，也要保持上下文衔接。"
-                        "输出与输入同一语种，并保持 Markdown 中的段落结构。"
-                    ),
+                    "content": KIMI_SYSTEM_PROMPT,
                 },
                 {
                     "role": "user",
@@ -396,8 +1035,12 @@ def _refine_single_chunk(text: str, prompt: str) -> str:
                     ),
                 },
             ],
-            temperature=0.15,  # 降低随机性，避免过度创作
-            max_tokens=32000,  # 最大输出 tokens（k2 模型支持更大，但这里设置一个合理的上限）
+            temperature=KIMI_TEMPERATURE,
+            # 最大输出 tokens：不超过上下文窗口中除输入以外的剩余部分
+            max_tokens=max(1, min(
+                KIMI_MAX_OUTPUT_TOKENS,
+                _get_model_max_tokens(KIMI_MODEL) - _count_tokens(text) - _prompt_overhead_tokens(prompt),
+            )),
         )
         
         # 获取返回的内容
@@ -407,5 +1050,5 @@ def _refine_single_chunk(text: str, prompt: str) -> str:
             raise RuntimeError("Kimi API 返回空结果")
             
     except Exception as e:
-        raise RuntimeError(f"Kimi API 调用失败: {str(e)}")
+        raise RuntimeError(f"Kimi API 调用失败: {str(e)}") from e
     
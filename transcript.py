@@ -0,0 +1,110 @@
+"""
+转写结果输出：切片一完成就追加写入 outputs/<文件夹>.md 以及 SRT、WebVTT 字幕，长视频转写过程中即可查看已完成的部分；
+全部完成后重写规范的 Markdown，并导出带时间戳的 JSON。
+字幕和 JSON 的时间为切片内 segment 的起止时间加上切片在源音频中的偏移，可直接对应到原视频。
+输出格式通过 OUTPUT_FORMATS 配置（逗号分隔，默认 md,srt,vtt,json），Markdown 始终生成。
+"""
+import json
+import os
+
+OUTPUT_DIR = "outputs"
+FORMATS = ("md", "srt", "vtt", "json")
+
+
+def output_formats():
+    formats = {f.strip().lower() for f in os.getenv("OUTPUT_FORMATS", ",".join(FORMATS)).split(",")}
+    return [f for f in FORMATS if f in formats or f == "md"]
+
+
+def format_timestamp(seconds, separator=","):
+    """秒数转为 HH:MM:SS,mmm（SRT）或 HH:MM:SS.mmm（WebVTT）"""
+    millis = max(0, int(round(seconds * 1000)))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}{separator}{millis:03d}"
+
+
+def absolute_segments(audio_slice, result, offset):
+    """
+    把切片结果中的 segment 换算为源音频中的绝对时间。
+    offset 为切片起点（切片没有记录 start 时由调用方按前一切片的结束时间推算）；
+    没有 segment 但有文本时，用整个切片作为一个 segment。
+    """
+    segments = []
+    for seg in result.get("segments") or []:
+        text = seg.get("text", "").strip()
+        if text:
+            segments.append({"start": offset + seg["start"], "end": offset + seg["end"], "text": text})
+    if not segments and result.get("text", "").strip():
+        end = audio_slice.get("end", offset)
+        segments.append({"start": offset, "end": max(end, offset), "text": result["text"].strip()})
+    for seg in segments:
+        seg["slice"] = audio_slice.get("index")
+    return segments
+
+
+def _write_atomic(path, content):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class TranscriptWriter:
+    """按切片顺序接收转写结果并增量写入各格式文件"""
+
+    def __init__(self, folder, formats=None):
+        self.folder = folder
+        self.formats = formats or output_formats()
+        self.texts = []
+        self.segments = []
+        self.offset = 0.0
+        self.cue = 0
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        self.files = {}
+        for fmt in ("md", "srt", "vtt"):
+            if fmt in self.formats:
+                # 行缓冲：每个切片写完即可被其他程序读到
+                self.files[fmt] = open(self.path(fmt), "w", encoding="utf-8", buffering=1)
+        self.files["md"].write("# 转写结果（原始）\n\n")
+        if "vtt" in self.files:
+            self.files["vtt"].write("WEBVTT\n\n")
+
+    def path(self, fmt):
+        return os.path.join(OUTPUT_DIR, f"{self.folder}.{fmt}")
+
+    def add(self, audio_slice, result):
+        offset = audio_slice.get("start", self.offset)
+        segments = absolute_segments(audio_slice, result, offset)
+        self.offset = audio_slice.get("end", segments[-1]["end"] if segments else offset)
+        self.texts.append(result["text"])
+        self.segments.extend(segments)
+        self.files["md"].write(result["text"] + "\n")
+        for seg in segments:
+            self.cue += 1
+            if "srt" in self.files:
+                self.files["srt"].write(f"{self.cue}\n{format_timestamp(seg['start'])} --> "
+                                        f"{format_timestamp(seg['end'])}\n{seg['text']}\n\n")
+            if "vtt" in self.files:
+                self.files["vtt"].write(f"{format_timestamp(seg['start'], '.')} --> "
+                                        f"{format_timestamp(seg['end'], '.')}\n{seg['text']}\n\n")
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def finish(self):
+        """全部切片完成后重写 Markdown 并导出 JSON，返回原始转写文本"""
+        self.close()
+        raw_text = "\n".join(self.texts)
+        _write_atomic(self.path("md"), "# 转写结果（原始）\n\n" + raw_text.strip() + "\n")
+        print(f"原始转写结果已保存为 Markdown: {self.path('md')}")
+        if "json" in self.formats:
+            data = {"folder": self.folder, "text": raw_text, "segments": self.segments}
+            _write_atomic(self.path("json"), json.dumps(data, ensure_ascii=False, indent=2))
+        exports = [self.path(fmt) for fmt in self.formats if fmt != "md"]
+        if exports:
+            print(f"带时间戳的转写结果已导出: {', '.join(exports)}")
+        return raw_text
@@ -1,10 +1,35 @@
+import contextvars
 import os
 import re
 import subprocess
 import glob  # 新增导入
+import hashlib
+import json
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
+import cache
+import metrics
+from ratelimit import backoff_delay
+
+MEDIA_EXTS = ['.mp4', '.m4v', '.mov', '.mkv', '.flv', '.webm', '.avi']
+AUDIO_EXTS = ['.m4a', '.mp3', '.aac', '.opus', '.ogg', '.wav', '.flac']
+BILI_VIEW_TTL = int(os.getenv("BILI_VIEW_TTL", str(24 * 3600)))  # 视频信息缓存时长（秒）
+BILI_PLAYURL_TTL = int(os.getenv("BILI_PLAYURL_TTL", "1800"))  # 直链有效期较短，默认缓存 30 分钟
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "4"))  # 直链分段下载的并发连接数，1 表示单连接
+RANGE_SEGMENT_BYTES = 4 * 1024 * 1024  # 分段下载时每段的大小，也是断点续传的粒度
+DOWNLOAD_RETRIES = 4  # 单个分段的最大尝试次数
+
+def use_audio_only():
+    """是否只下载音频轨（AUDIO_ONLY=1）：yt-dlp 选择 bestaudio，B站接口选择 DASH 音频流"""
+    return str(os.getenv("AUDIO_ONLY", "0")).lower() not in ("0", "false", "no")
+
+# 同一视频的并发下载合并为一次：后到的请求等待先到的完成后直接复用结果
+_download_locks = {}
+_download_locks_guard = threading.Lock()
 
 def ensure_folders_exist(output_dir):
     if not os.path.exists("bilibili_video"):
@@ -32,16 +57,171 @@ def _detect_source(link_or_bv: str):
                 video_id = (qs.get("v") or [None])[0]
             if video_id:
                 return "youtube", f"yt_{video_id}", link_or_bv
-            # 没拿到 ID 也允许下载，使用完整链接
-            return "youtube", "yt_video", link_or_bv
+            # 没拿到 ID 也允许下载，用完整链接的摘要作为标识，不同链接不会共用同一个文件
+            return "youtube", f"yt_{_url_id(link_or_bv)}", link_or_bv
         # 其他站点仍用 yt-dlp 下载
-        return "generic", "video", link_or_bv
+        return "generic", f"video_{_url_id(link_or_bv)}", link_or_bv
     # 非链接，尝试按 BV 处理
     if not link_or_bv.startswith("BV"):
         link_or_bv = "BV" + link_or_bv
     return "bilibili", link_or_bv, f"https://www.bilibili.com/video/{link_or_bv}"
 
 
+def _url_id(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+
+
+def _download_lock(file_id):
+    with _download_locks_guard:
+        return _download_locks.setdefault(file_id, threading.Lock())
+
+def _file_digests(path, *algorithms):
+    """读取一遍文件，同时计算多种校验和"""
+    hashes = {name: hashlib.new(name) for name in algorithms}
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            for h in hashes.values():
+                h.update(block)
+    return {name: h.hexdigest() for name, h in hashes.items()}
+
+def _index_media(file_id, path):
+    """记录 ID → 文件路径、大小，供后续请求跳过下载（下载时已校验完整性，这里只比较大小）"""
+    if not cache.enabled():
+        return
+    cache.put("media", cache.make_key("media-v1", file_id), {
+        "path": path,
+        "size": os.path.getsize(path),
+    })
+
+def _verify_download(part_path, written, expected_sizes, digest=None, expected_digest=None):
+    """校验下载得到的字节数与校验和，不一致时删除临时文件并抛出 IOError"""
+    for expected in expected_sizes:
+        if expected and written != int(expected):
+            os.remove(part_path)
+            raise IOError(f"下载不完整: 收到 {written} 字节，应为 {expected} 字节")
+    if expected_digest and digest != expected_digest.lower():
+        os.remove(part_path)
+        raise IOError(f"下载文件校验和不匹配: {digest} != {expected_digest}")
+
+def _stream_download(session, url, headers, part_path, with_md5=False):
+    """
+    单连接流式下载到 part_path，边写入边统计大小、计算校验和，下载结束即可判断文件是否完整，无需再读一遍。
+    返回 (写入字节数, Content-Length, md5)。
+    """
+    md5 = hashlib.md5() if with_md5 else None
+    written = 0
+    with session.get(url, headers=headers, stream=True, timeout=60) as resp:
+        resp.raise_for_status()
+        content_length = 0 if resp.headers.get("Content-Encoding") else int(resp.headers.get("Content-Length") or 0)
+        with open(part_path, "wb") as f:
+            for chunk in resp.iter_content(chunk_size=1024 * 256):
+                if chunk:
+                    f.write(chunk)
+                    if md5 is not None:
+                        md5.update(chunk)
+                    written += len(chunk)
+    return written, content_length, md5.hexdigest() if md5 is not None else None
+
+def _probe_range_support(session, url, headers):
+    """请求第一个字节，探测服务器是否支持 Range 分段下载。支持时返回文件总字节数，否则返回 None。"""
+    with session.get(url, headers={**headers, "Range": "bytes=0-0"}, stream=True, timeout=30) as resp:
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            return None
+        total = resp.headers.get("Content-Range", "").rsplit("/", 1)[-1]  # 形如 bytes 0-0/123456
+        return int(total) if total.isdigit() else None
+
+def _load_progress(progress_path, total, segment_bytes):
+    """读取分段下载的进度文件，文件大小或分段大小不一致时视为没有进度"""
+    try:
+        with open(progress_path, "r", encoding="utf-8") as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if progress.get("size") != total or progress.get("segment_bytes") != segment_bytes:
+        return set()
+    return set(progress.get("done", []))
+
+def _save_progress(progress_path, total, segment_bytes, done):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"size": total, "segment_bytes": segment_bytes, "done": sorted(done)}, f)
+    os.replace(tmp_path, progress_path)
+
+def _ranged_download(session, url, headers, part_path, total,
+                     connections=DOWNLOAD_CONNECTIONS, segment_bytes=RANGE_SEGMENT_BYTES):
+    """
+    多连接分段下载：文件按 segment_bytes 切成若干 HTTP Range 段，由 connections 个线程并行下载，
+    各自写入预分配好的 part_path 的对应位置。每完成一段就记录到 part_path + ".json"，
+    下载中断后再次调用会跳过已完成的段，只补齐剩余部分。
+    """
+    progress_path = part_path + ".json"
+    segments = [(index, start, min(start + segment_bytes, total) - 1)
+                for index, start in enumerate(range(0, total, segment_bytes))]
+    if os.path.exists(part_path) and os.path.getsize(part_path) == total:
+        done = _load_progress(progress_path, total, segment_bytes)
+    else:
+        with open(part_path, "wb") as f:
+            f.truncate(total)  # 预分配，各线程直接写入自己的位置
+        done = set()
+    if done:
+        print(f"继续未完成的下载: 已完成 {len(done)}/{len(segments)} 段")
+    lock = threading.Lock()
+
+    def fetch(index, start, end):
+        expected = end - start + 1
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                written = 0
+                with session.get(url, headers={**headers, "Range": f"bytes={start}-{end}"}, stream=True, timeout=60) as resp:
+                    resp.raise_for_status()
+                    if resp.status_code != 206:
+                        raise IOError(f"服务器未按 Range 返回分段 {index}")
+                    with open(part_path, "r+b") as f:
+                        f.seek(start)
+                        for chunk in resp.iter_content(chunk_size=1024 * 256):
+                            chunk = chunk[:expected - written]  # 防止越界覆盖相邻的分段
+                            f.write(chunk)
+                            written += len(chunk)
+                if written != expected:
+                    raise IOError(f"分段 {index} 不完整: 收到 {written} 字节，应为 {expected} 字节")
+                break
+            except (requests.RequestException, OSError) as e:
+                if attempt == DOWNLOAD_RETRIES - 1:
+                    raise
+                print(f"分段 {index} 下载失败，稍后重试: {e}")
+                time.sleep(backoff_delay(attempt))
+        with lock:
+            done.add(index)
+            _save_progress(progress_path, total, segment_bytes, done)
+
+    pending = [segment for segment in segments if segment[0] not in done]
+    _save_progress(progress_path, total, segment_bytes, done)
+    with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+        # 任一分段最终失败时抛出异常；其余分段仍会完成并记录进度，下次调用可以续传
+        for future in as_completed([pool.submit(contextvars.copy_context().run, fetch, *segment) for segment in pending]):
+            future.result()
+
+def _find_complete_media(output_dir):
+    """查找目录中已完整下载的媒体文件；存在 yt-dlp 未完成的临时文件时视为不完整"""
+    if glob.glob(os.path.join(output_dir, "*.part")) or glob.glob(os.path.join(output_dir, "*.ytdl")):
+        return None
+    for ext in MEDIA_EXTS + AUDIO_EXTS:
+        files = [f for f in glob.glob(os.path.join(output_dir, "*" + ext)) if not f.endswith("_remux.mp4")]
+        if files:
+            return files[0]
+    return None
+
+def lookup_media(file_id, output_dir=None):
+    """返回本地已下载且完整的媒体文件路径，未找到时返回 None"""
+    entry = cache.get("media", cache.make_key("media-v1", file_id))
+    if entry and os.path.exists(entry["path"]) and os.path.getsize(entry["path"]) == entry["size"]:
+        return entry["path"]
+    path = _find_complete_media(output_dir or f"bilibili_video/{file_id}")
+    if path:
+        _index_media(file_id, path)
+    return path
+
 def download_video(link_or_bv):
     """
     下载视频（B站/YouTube/其他支持的站点）。
@@ -51,6 +231,19 @@ def download_video(link_or_bv):
         成功时返回文件标识符（用于后续音频处理），失败时返回None
     """
     source, file_id, video_url = _detect_source(str(link_or_bv))
+    with metrics.timed("download", source=source, audio_only=use_audio_only()) as m, _download_lock(file_id):
+        path = lookup_media(file_id)
+        m["cached"] = path is not None
+        if path:
+            print(f"已存在完整的视频文件，跳过下载: {path}")
+        else:
+            path = _download_video(source, file_id, video_url)
+        m["bytes"] = os.path.getsize(path) if path else None
+        m["ok"] = path is not None
+        return file_id if path else None
+
+def _download_video(source, file_id, video_url):
+    """下载到 bilibili_video/<file_id>/ 并登记到媒体索引，返回文件路径，失败时返回 None"""
     output_dir = f"bilibili_video/{file_id}"  # 统一放在 bilibili_video 下，便于后续处理
     ensure_folders_exist(output_dir)
     print(f"使用yt-dlp下载视频: {video_url}")
@@ -63,7 +256,10 @@ def download_video(link_or_bv):
             extra_headers = ["--referer", "https://www.bilibili.com", "--add-header", "User-Agent: Mozilla/5.0"]
 
         format_args = []
-        if source == "youtube":
+        if use_audio_only():
+            # 只需要语音：优先 m4a 音频流，站点不提供单独音轨时退回体积最小的完整文件
+            format_args = ["-f", "ba[ext=m4a]/ba/wv*+ba/w"]
+        elif source == "youtube":
             # 优先下载 mp4 + m4a，避免 webm/opus 解析问题
             format_args = ["-f", "bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]/best"]
 
@@ -94,9 +290,14 @@ def download_video(link_or_bv):
                     video_files = glob.glob(os.path.join(output_dir, "*.mkv"))
                 if not video_files:
                     video_files = glob.glob(os.path.join(output_dir, "*.webm"))
+                for ext in AUDIO_EXTS:
+                    if video_files:
+                        break
+                    video_files = glob.glob(os.path.join(output_dir, "*" + ext))
             
             if video_files:
                 print(f"视频已成功下载到目录: {output_dir}")
+                _index_media(file_id, video_files[0])
                 # 删除xml文件和其他不需要的文件
                 xml_files = glob.glob(os.path.join(output_dir, "*.xml"))
                 for xml_file in xml_files:
@@ -104,7 +305,7 @@ def download_video(link_or_bv):
                         os.remove(xml_file)
                     except:
                         pass
-                return file_id
+                return video_files[0]
             else:
                 print(f"下载完成但未找到视频文件: {output_dir}")
         else:
@@ -128,54 +329,99 @@ def download_video(link_or_bv):
             "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
         }
         session = requests.Session()
-        # 先访问首页拿基础cookie，避免接口返回412
-        session.get("https://www.bilibili.com", headers=headers, timeout=10)
+        # 连接池容量要覆盖分段下载的并发连接数，否则多出的连接用完即被丢弃、无法复用
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(DOWNLOAD_CONNECTIONS, 10))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        warmed_up = []
+
+        def api_get(url, params, namespace, ttl):
+            """带 TTL 缓存的接口请求，缓存命中时完全不访问网络"""
+            key = cache.make_key(url, params)
+            data = cache.get(namespace, key, ttl=ttl)
+            if data is not None:
+                return data
+            if not warmed_up:
+                # 先访问首页拿基础cookie，避免接口返回412
+                session.get("https://www.bilibili.com", headers=headers, timeout=10)
+                warmed_up.append(True)
+            data = session.get(url, params=params, headers=headers, timeout=10).json()
+            if data.get("code") == 0:
+                cache.put(namespace, key, data)
+            return data
 
         # 获取cid等信息
-        view_resp = session.get(
+        view_resp = api_get(
             "https://api.bilibili.com/x/web-interface/view",
-            params={"bvid": file_id},
-            headers=headers,
-            timeout=10,
-        ).json()
+            {"bvid": file_id},
+            "bili_view",
+            BILI_VIEW_TTL,
+        )
         if view_resp.get("code") != 0:
             print(f"获取视频信息失败: {view_resp.get('message')}")
             return None
         cid = view_resp["data"]["cid"]
         title = view_resp["data"]["title"]
 
-        play_resp = session.get(
-            "https://api.bilibili.com/x/player/playurl",
-            params={
-                "bvid": file_id,
-                "cid": cid,
-                "qn": 80,  # 720P，兼顾下载速度
-                "fnval": 0,
-                "platform": "html5",
-                "high_quality": 1,
-            },
-            headers=headers,
-            timeout=10,
-        ).json()
-        durls = play_resp.get("data", {}).get("durl") or []
-        if not durls:
-            print(f"直链获取失败: {play_resp.get('message')}")
-            return None
+        media = None
+        if use_audio_only():
+            # fnval=16 请求 DASH 格式，音视频分轨，只取音频流
+            play_resp = api_get(
+                "https://api.bilibili.com/x/player/playurl",
+                {"bvid": file_id, "cid": cid, "fnval": 16},
+                "bili_playurl",
+                BILI_PLAYURL_TTL,
+            )
+            audios = ((play_resp.get("data") or {}).get("dash") or {}).get("audio") or []
+            if audios:
+                # 语音识别不需要高码率，选择码率最低的音频流
+                audio = min(audios, key=lambda a: a.get("bandwidth") or 0)
+                media = {"url": audio.get("baseUrl") or audio.get("base_url"), "ext": ".m4a"}
+                print(f"使用DASH音频流，码率约 {(audio.get('bandwidth') or 0) // 1000} kbps")
+            else:
+                print(f"未获取到音频流，改为下载完整视频: {play_resp.get('message')}")
+        if media is None:
+            play_resp = api_get(
+                "https://api.bilibili.com/x/player/playurl",
+                {
+                    "bvid": file_id,
+                    "cid": cid,
+                    "qn": 80,  # 720P，兼顾下载速度
+                    "fnval": 0,
+                    "platform": "html5",
+                    "high_quality": 1,
+                },
+                "bili_playurl",
+                BILI_PLAYURL_TTL,
+            )
+            durls = play_resp.get("data", {}).get("durl") or []
+            if not durls:
+                print(f"直链获取失败: {play_resp.get('message')}")
+                return None
+            media = {"url": durls[0]["url"], "size": durls[0].get("size"), "md5": durls[0].get("md5")}
 
-        video_url = durls[0]["url"]
+        video_url = media["url"]
         parsed_path = urlparse(video_url).path
-        ext = os.path.splitext(parsed_path)[1] or ".mp4"
+        ext = media.get("ext") or os.path.splitext(parsed_path)[1] or ".mp4"
         safe_title = re.sub(r'[\\\\/:*?"<>|]+', "_", title).strip() or file_id
         output_path = os.path.join(output_dir, f"{safe_title}{ext}")
+        part_path = output_path + ".part"
 
-        with session.get(video_url, headers=headers, stream=True, timeout=60) as resp:
-            resp.raise_for_status()
-            with open(output_path, "wb") as f:
-                for chunk in resp.iter_content(chunk_size=1024 * 256):
-                    if chunk:
-                        f.write(chunk)
+        expected_md5 = media.get("md5")
+        total = _probe_range_support(session, video_url, headers) if DOWNLOAD_CONNECTIONS > 1 else None
+        if total:
+            _ranged_download(session, video_url, headers, part_path, total)
+            md5 = _file_digests(part_path, "md5")["md5"] if expected_md5 else None
+            _verify_download(part_path, os.path.getsize(part_path), (total, media.get("size")), md5, expected_md5)
+            os.remove(part_path + ".json")
+        else:
+            # 服务器不支持 Range 时退回单连接下载
+            written, content_length, md5 = _stream_download(session, video_url, headers, part_path, bool(expected_md5))
+            _verify_download(part_path, written, (content_length, media.get("size")), md5, expected_md5)
+        os.replace(part_path, output_path)
         print(f"直链下载成功: {output_path}")
-        return file_id
+        _index_media(file_id, output_path)
+        return output_path
     except Exception as e:
         print("直链下载失败:", str(e))
         import traceback
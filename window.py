@@ -1,16 +1,29 @@
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
 import webbrowser
+import os
+import queue
 import re
 import sys
 import threading
+import time
 from utils import download_video
-from exAudio import convert_flv_to_mp3, split_mp3, process_audio_split
+from exAudio import convert_flv_to_mp3, split_mp3, process_audio_split, process_audio_memory, use_in_memory_audio
+from pipeline import run_pipeline, use_stream_pipeline
+import checkpoint
+import daemon
 
 speech_to_text = None  # 模型实例
 last_folder_name = None  # 存储最后处理的文件夹名称，用于AI修订
 stop_event = threading.Event()  # 用于控制任务停止的事件
 current_task_thread = None  # 当前正在执行的任务线程
+LOG_MAX_LINES = int(os.getenv("GUI_LOG_MAX_LINES", "2000"))  # 日志窗口最多保留的行数，更早的日志只保存在日志文件中
+LOG_DIR = os.getenv("GUI_LOG_DIR", "logs")  # 完整日志文件的保存目录
+LOG_FLUSH_MS = 100  # 日志窗口的刷新间隔（毫秒）
+LOG_BATCH_LINES = 500  # 每次刷新最多写入日志窗口的行数
+log_queue = queue.Queue()  # 任意线程产生的日志行，由界面线程定时取出
+log_spool = None  # 完整日志文件
+_log_spool_lock = threading.Lock()
 
 def is_cuda_available(whisper):
     return whisper.torch.cuda.is_available()
@@ -43,15 +56,39 @@ def open_popup(text, title="提示"):
     return user_choice.get()
 
 def show_log(text, state="INFO"):
+    _enqueue_log(f"[LOG][{state}] {text}")
 
-    log_text.config(state="normal")
-    log_text.insert(END, f"[LOG][{state}] {text}\n")
-    log_text.config(state="disabled")
+def _enqueue_log(line):
+    """记录一行日志：立即写入日志文件，并放入队列等待界面线程显示（可在任意线程调用）"""
+    if log_spool is not None:
+        with _log_spool_lock:
+            log_spool.write(line + "\n")
+            log_spool.flush()
+    log_queue.put(line)
+
+def drain_log_queue():
+    """在界面线程中定时执行：批量取出日志写入窗口，并只保留最近 LOG_MAX_LINES 行"""
+    lines = []
+    try:
+        while len(lines) < LOG_BATCH_LINES:
+            lines.append(log_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if lines:
+        log_text.config(state="normal")
+        log_text.insert(END, "\n".join(lines) + "\n")
+        excess = int(log_text.index("end-1c").split(".")[0]) - 1 - LOG_MAX_LINES
+        if excess > 0:
+            log_text.delete("1.0", f"{excess + 1}.0")
+        log_text.config(state="disabled")
+        log_text.see(END)
+    # 队列中还有积压时尽快继续，否则按固定间隔刷新
+    log_text.after(1 if len(lines) == LOG_BATCH_LINES else LOG_FLUSH_MS, drain_log_queue)
 
 def on_submit_click():
     global speech_to_text, current_task_thread, stop_event
-    if speech_to_text is None:
-        print("Whisper未加载！请点击加载Whisper按钮。")
+    if speech_to_text is None and not daemon.is_running():
+        print("Whisper未加载！请点击加载Whisper按钮，或先启动常驻转写服务（python daemon.py serve）。")
         return
     video_link = video_link_entry.get()
     if not video_link:
@@ -71,6 +108,12 @@ def on_submit_click():
 def process_video(video_link):
     global last_folder_name, stop_event
     try:
+        if speech_to_text is None:
+            process_video_daemon(video_link)
+            return
+        if use_stream_pipeline():
+            process_video_streaming(video_link)
+            return
         print("=" * 10)
         print("正在下载视频...")
         if stop_event.is_set():
@@ -86,8 +129,13 @@ def process_video(video_link):
             return
         print("=" * 10)
         print("正在分割音频...")
-        # 使用音频模块处理
-        folder_name = process_audio_split(file_identifier)
+        # 使用音频模块处理（内存模式下不生成中间 MP3 切片）
+        slices = None
+        slice_length = speech_to_text.preferred_slice_length()
+        if use_in_memory_audio():
+            folder_name, slices = process_audio_memory(file_identifier, slice_length)
+        else:
+            folder_name = process_audio_split(file_identifier, slice_length)
         if stop_event.is_set():
             print("任务已停止")
             return
@@ -98,7 +146,9 @@ def process_video(video_link):
         if hasattr(speech_to_text, 'set_stop_event'):
             speech_to_text.set_stop_event(stop_event)
         speech_to_text.run_analysis(folder_name, 
-            prompt="以下是普通话的句子。这是一个关于{}的视频。".format(file_identifier))
+            prompt="以下是普通话的句子。这是一个关于{}的视频。".format(file_identifier),
+            slices=slices,
+            job_info={"file_id": file_identifier, "link": str(video_link), "slice_length": slice_length})
         if stop_event.is_set():
             print("任务已停止")
             return
@@ -108,6 +158,7 @@ def process_video(video_link):
     except KeyboardInterrupt:
         print("=" * 10)
         print("任务已停止")
+        print("已完成的切片已保存到断点，点击'再次生成'可以继续转写。")
     except FileNotFoundError as e:
         print("=" * 10)
         print(f"处理失败: {e}")
@@ -122,29 +173,95 @@ def process_video(video_link):
         # 任务完成或停止后，更新按钮状态
         update_button_states(False)
 
+def process_video_streaming(video_link):
+    """流式管线：下载、解码、切片与转写同时进行（异常由 process_video 统一处理）"""
+    global last_folder_name
+    print("=" * 10)
+    print("正在以流式管线处理视频（边下载边转写）...")
+    if hasattr(speech_to_text, 'set_stop_event'):
+        speech_to_text.set_stop_event(stop_event)
+    file_identifier, folder_name = run_pipeline(
+        video_link, speech_to_text, slice_length=speech_to_text.preferred_slice_length())
+    last_folder_name = folder_name
+    if stop_event.is_set():
+        print("任务已停止")
+        return
+    output_path = f"outputs/{folder_name}.md"
+    print("转换完成！原始文档已保存：", output_path)
+    print("提示：如需AI润色，请点击'AI修订'按钮。")
+
+def process_video_daemon(video_link):
+    """本地未加载模型时交给常驻转写服务处理，服务端日志实时显示在界面上（异常由 process_video 统一处理）"""
+    global last_folder_name
+    print("=" * 10)
+    print("检测到常驻转写服务，任务已提交给服务处理...")
+    job = daemon.submit(str(video_link), model=model_var.get())
+    job = daemon.wait(job["id"], on_log=print, stop_event=stop_event)
+    if job["status"] == "cancelled":
+        print("任务已停止")
+        return
+    if job["status"] == "failed":
+        print(f"处理失败: {job['error']}")
+        return
+    last_folder_name = job["folder"]
+    print("转换完成！原始文档已保存：", job["output"])
+    print("提示：如需AI润色，请点击'AI修订'按钮。")
+
 def on_generate_again_click():
-    print("再次生成...")
-    print(open_popup("是否再次生成？"))
+    """从断点继续最近一次被停止或中断的转写任务"""
+    global current_task_thread
+    if speech_to_text is None and not daemon.is_running():
+        print("Whisper未加载！请点击加载Whisper按钮，或先启动常驻转写服务（python daemon.py serve）。")
+        return
+    state = checkpoint.load(last_folder_name) if last_folder_name else None
+    if state is None or state["finished"]:
+        # 本次运行没有中断的任务时，取断点目录中最近的未完成任务（例如上次程序崩溃留下的）
+        jobs = checkpoint.unfinished()
+        if not jobs:
+            print("没有可以继续的转写任务。")
+            return
+        state = checkpoint.load(jobs[0]["folder"])
+    folder_name = state["job"]["folder"]
+    text = f"是否继续转写 {state['job'].get('file_id') or folder_name}？\n已完成 {len(state['slices'])} 个切片"
+    if open_popup(text, title="再次生成") == "cancelled":
+        return
+    stop_event.clear()
+    current_task_thread = threading.Thread(target=resume_video, args=(folder_name,))
+    current_task_thread.start()
+    update_button_states(True)
 
-def on_clear_log_click():
-    # 临时恢复原始 stdout/stderr，避免清空期间的输出被重定向回 log_text
+def resume_video(folder_name):
+    global last_folder_name
+    last_folder_name = folder_name
     try:
-        sys.stdout = _orig_stdout
-        sys.stderr = _orig_stderr
-    except NameError:
-        # 如果还没初始化原始对象，跳过
-        pass
-    try:
-        log_text.config(state="normal")
-        log_text.delete('1.0', END)
-        log_text.config(state="disabled")
+        print("=" * 10)
+        print(f"正在从断点继续转写: {folder_name}")
+        if speech_to_text is None:
+            job = daemon.wait(daemon.submit(folder=folder_name, resume=True, model=model_var.get())["id"],
+                              on_log=print, stop_event=stop_event)
+            if job["status"] != "done":
+                print("任务已停止" if job["status"] == "cancelled" else f"处理失败: {job['error']}")
+                return
+        else:
+            speech_to_text.set_stop_event(stop_event)
+            speech_to_text.resume_analysis(folder_name)
+        print("转换完成！原始文档已保存：", f"outputs/{folder_name}.md")
+        print("提示：如需AI润色，请点击'AI修订'按钮。")
+    except KeyboardInterrupt:
+        print("=" * 10)
+        print("任务已停止")
+        print("已完成的切片已保存到断点，点击'再次生成'可以继续转写。")
+    except Exception as e:
+        print("=" * 10)
+        print(f"处理过程中发生错误: {e}")
     finally:
-        # 重新启用重定向（如果之前启用了）
-        try:
-            redirect_system_io()
-        except Exception:
-            # 避免在清空日志时抛出异常导致界面卡住
-            pass
+        update_button_states(False)
+
+def on_clear_log_click():
+    # 只清空窗口中的日志，日志文件保留完整记录
+    log_text.config(state="normal")
+    log_text.delete('1.0', END)
+    log_text.config(state="disabled")
 
 def on_show_result_click():
     print("这里是结果...")
@@ -177,7 +294,7 @@ def update_button_states(task_running):
 def on_ai_refine_click():
     """AI修订按钮点击处理"""
     global speech_to_text, last_folder_name, current_task_thread, stop_event
-    if speech_to_text is None:
+    if speech_to_text is None and not daemon.is_running():
         print("Whisper未加载！请先加载Whisper模型。")
         return
     if last_folder_name is None:
@@ -205,10 +322,17 @@ def refine_text_with_ai(folder_name):
         # 从原始文档中提取file_identifier用于prompt
         # 这里简化处理，使用folder_name
         prompt = "以下是普通话的句子。这是一个关于{}的视频。".format(folder_name)
-        # 传递停止事件给 speech2text
-        if hasattr(speech_to_text, 'set_stop_event'):
-            speech_to_text.set_stop_event(stop_event)
-        speech_to_text.refine_text(folder_name, prompt=prompt)
+        if speech_to_text is None:
+            # 交给常驻转写服务润色
+            job = daemon.wait(daemon.submit(folder=folder_name, refine=True, prompt=prompt)["id"],
+                              on_log=print, stop_event=stop_event)
+            if job["status"] == "failed":
+                raise RuntimeError(job["error"])
+        else:
+            # 传递停止事件给 speech2text
+            if hasattr(speech_to_text, 'set_stop_event'):
+                speech_to_text.set_stop_event(stop_event)
+            speech_to_text.refine_text(folder_name, prompt=prompt)
         if stop_event.is_set():
             print("任务已停止")
             return
@@ -285,50 +409,43 @@ def open_github_link(event=None):
     webbrowser.open_new("https://github.com/lanbinshijie/bili2text")
 
 def redirect_system_io():
-    global _orig_stdout, _orig_stderr
-    # 仅在首次调用时保存原始 stdout/stderr
+    global _orig_stdout, _orig_stderr, log_spool
+    # 仅在首次调用时保存原始 stdout/stderr，并打开完整日志文件
     if '_orig_stdout' not in globals():
         _orig_stdout = sys.stdout
         _orig_stderr = sys.stderr
+        try:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            log_spool = open(os.path.join(LOG_DIR, f"window_{time.strftime('%Y%m%d%H%M%S')}.log"), "a", encoding="utf-8")
+        except OSError:
+            log_spool = None
 
     class StdoutRedirector:
+        """
+        线程安全的输出重定向：只把完整的行放入日志队列，不直接操作界面控件，
+        由界面线程通过 drain_log_queue 批量显示，避免工作线程频繁写入导致界面卡顿。
+        """
         def __init__(self):
             self._buffer = ""
+            self._lock = threading.Lock()
         def write(self, message, state="INFO"):
             if not message:
                 return
             # 跳过进度信息
             if "Speed" in message:
                 return
-            self._buffer += message
-            # 只在遇到换行时写入完整行，避免把片段拆成多行日志
-            while "\n" in self._buffer:
-                line, self._buffer = self._buffer.split("\n", 1)
+            with self._lock:
+                self._buffer += message
+                # 只在遇到换行时写入完整行，避免把片段拆成多行日志
+                *lines, self._buffer = self._buffer.split("\n")
+            for line in lines:
                 if line.strip():
-                    try:
-                        log_text.config(state="normal")
-                        log_text.insert(END, f"[LOG][{state}] {line}\n")
-                        log_text.config(state="disabled")
-                        log_text.see(END)
-                    except Exception:
-                        # 如果 UI 还没准备好，回退写到原始 stdout，避免丢失日志或递归
-                        try:
-                            _orig_stdout.write(line + "\n")
-                        except Exception:
-                            pass
+                    _enqueue_log(f"[LOG][{state}] {line}")
         def flush(self):
-            if self._buffer.strip():
-                try:
-                    log_text.config(state="normal")
-                    log_text.insert(END, f"[LOG][INFO] {self._buffer}\n")
-                    log_text.config(state="disabled")
-                    log_text.see(END)
-                except Exception:
-                    try:
-                        _orig_stdout.write(self._buffer + "\n")
-                    except Exception:
-                        pass
-            self._buffer = ""
+            with self._lock:
+                line, self._buffer = self._buffer, ""
+            if line.strip():
+                _enqueue_log(f"[LOG][INFO] {line}")
 
     # 安装重定向器
     sys.stdout = StdoutRedirector()
@@ -387,6 +504,9 @@ def main():
     github_link.bind("<Button-1>", open_github_link)
     
     redirect_system_io()
+    drain_log_queue()
+    if log_spool is not None:
+        print(f"完整日志保存在: {log_spool.name}")
     app.mainloop()
 
 if __name__ == "__main__":
@@ -1,133 +1,268 @@
 # -*- coding: utf-8 -*-
+"""
+讯飞开放平台录音文件转写（LFASR）客户端。
+上传直接从磁盘流式读取；多个切片/文件并发上传，所有未完成的订单由同一个调度循环轮询，
+轮询间隔根据接口给出的预计耗时自适应增长，并与上传共用限速器。
+接口地址可通过 XUNFEI_HOST 修改，便于对接本地模拟服务进行测试。
+"""
 import base64
+import contextlib
 import hashlib
 import hmac
 import json
 import os
 import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-import urllib
 
-lfasr_host = 'https://raasr.xfyun.cn/v2/api'
+from ratelimit import RateLimiter, backoff_delay, retry_after
+
+lfasr_host = os.getenv("XUNFEI_HOST", 'https://raasr.xfyun.cn/v2/api')
 # 请求的接口名
 api_upload = '/upload'
 api_get_result = '/getResult'
 
+XUNFEI_MAX_CONCURRENCY = max(1, int(os.getenv("XUNFEI_MAX_CONCURRENCY", "4")))  # 同时上传的文件数
+XUNFEI_RPM = int(os.getenv("XUNFEI_RPM", "0"))  # 上传与查询合计的每分钟请求数上限，0 表示不限制
+XUNFEI_MAX_RETRIES = 4  # 429/5xx/网络错误时的重试次数
+POLL_MIN_INTERVAL = 1.0  # 查询结果的最短间隔（秒）
+POLL_MAX_INTERVAL = 30.0  # 查询结果的最长间隔（秒）
+STATUS_DONE = 4  # 订单状态：转写完成
+STATUS_FAILED = -1  # 订单状态：转写失败
+
+
+def get_signa(appid, secret_key, ts):
+    """以 secret_key 为 key，对 md5(appid + ts) 做 HmacSHA1 后 base64 编码"""
+    md5 = hashlib.md5((appid + ts).encode('utf-8')).hexdigest().encode('utf-8')
+    return base64.b64encode(hmac.new(secret_key.encode('utf-8'), md5, hashlib.sha1).digest()).decode('utf-8')
+
+
+@contextlib.contextmanager
+def _open_body(source):
+    """上传内容：bytes 直接发送，文件路径则打开文件交给 requests 流式读取，不整体载入内存"""
+    if isinstance(source, (bytes, bytearray)):
+        yield source
+    else:
+        with open(source, 'rb') as f:
+            yield f
+
+
+class XunfeiClient:
+    """线程安全的讯飞 LFASR 客户端，所有请求共用连接池与限速器"""
+
+    def __init__(self, appid=None, secret_key=None, host=None, max_concurrency=None, rpm=None):
+        self.appid = appid or os.getenv("XUNFEI_APPID")
+        self.secret_key = secret_key or os.getenv("XUNFEI_SECRET_KEY")
+        if not self.appid or not self.secret_key:
+            raise RuntimeError("缺少 XUNFEI_APPID 或 XUNFEI_SECRET_KEY，无法使用讯飞转写。")
+        self.host = (host or lfasr_host).rstrip('/')
+        self.max_concurrency = max_concurrency or XUNFEI_MAX_CONCURRENCY
+        self.limiter = RateLimiter(rpm=XUNFEI_RPM if rpm is None else rpm)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.max_concurrency + 1, 10))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _signed_params(self, params):
+        # 每次请求重新签名，长时间轮询时不会因为时间戳过期被拒绝
+        ts = str(int(time.time()))
+        return {"appId": self.appid, "signa": get_signa(self.appid, self.secret_key, ts), "ts": ts, **params}
+
+    def _post(self, api, params, source=None, stop_event=None):
+        """发送请求并返回响应 JSON；429/5xx/网络错误时退避重试，业务错误码直接抛出 RuntimeError"""
+        error = None
+        for attempt in range(XUNFEI_MAX_RETRIES + 1):
+            if not self.limiter.acquire(stop_event=stop_event):
+                raise KeyboardInterrupt("用户请求停止任务")
+            url = self.host + api + "?" + urllib.parse.urlencode(self._signed_params(params))
+            try:
+                if source is None:
+                    resp = self.session.post(url, headers={"Content-type": "application/json"}, timeout=60)
+                else:
+                    with _open_body(source) as body:
+                        resp = self.session.post(url, headers={"Content-type": "application/json"}, data=body, timeout=300)
+            except requests.RequestException as e:
+                error = e
+            else:
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    error = RuntimeError(f"讯飞接口返回 {resp.status_code}: {resp.text[:200]}")
+                    wait = retry_after(resp)
+                    if wait:
+                        self.limiter.pause(wait)
+                else:
+                    resp.raise_for_status()
+                    result = resp.json()
+                    if result.get("code") != "000000":
+                        raise RuntimeError(f"讯飞接口错误: {result.get('code')} {result.get('descInfo')}")
+                    return result
+            if attempt < XUNFEI_MAX_RETRIES:
+                print(f"讯飞接口请求失败，稍后重试（第{attempt + 1}次）: {error}")
+                time.sleep(backoff_delay(attempt))
+        raise RuntimeError(f"讯飞接口请求失败: {error}") from error
+
+    def upload(self, source, file_name=None, duration_ms=None, stop_event=None):
+        """上传音频（文件路径或 bytes），返回接口响应，其中 content 含 orderId 与 taskEstimateTime"""
+        if isinstance(source, (bytes, bytearray)):
+            file_len, file_name = len(source), file_name or "slice.wav"
+        else:
+            file_len, file_name = os.path.getsize(source), file_name or os.path.basename(source)
+        params = {"fileSize": file_len, "fileName": file_name, "duration": str(int(duration_ms or 200))}
+        return self._post(api_upload, params, source, stop_event)
+
+    def get_result(self, order_id, stop_event=None):
+        """查询一次订单状态与结果"""
+        return self._post(api_get_result, {"orderId": order_id, "resultType": "transfer,predict"}, None, stop_event)
+
+    def wait(self, order_id, estimate_ms=0, stop_event=None):
+        """轮询单个订单直到完成，返回最后一次查询的响应"""
+        interval = _first_interval(estimate_ms)
+        while True:
+            _sleep(interval, stop_event)
+            result = self.get_result(order_id, stop_event)
+            status = result['content']['orderInfo']['status']
+            if status == STATUS_DONE:
+                return result
+            if status == STATUS_FAILED:
+                raise RuntimeError(f"讯飞转写失败: 订单 {order_id} failType={result['content']['orderInfo'].get('failType')}")
+            interval = min(interval * 1.5, POLL_MAX_INTERVAL)
+
+    def _upload_slice(self, audio_slice, stop_event):
+        source = audio_slice.get("path")
+        if source is None:
+            from exAudio import array_to_wav_bytes
+            source = array_to_wav_bytes(audio_slice["audio"])
+        duration_ms = None
+        if "start" in audio_slice and "end" in audio_slice:
+            duration_ms = (audio_slice["end"] - audio_slice["start"]) * 1000
+        return self.upload(source, duration_ms=duration_ms, stop_event=stop_event)["content"]
+
+    def transcribe_slices(self, slices, stop_event=None):
+        """
+        并发转写多个切片或完整文件。切片格式与 speech2text 一致：{"path"} 或 {"audio"}，可附带 start/end。
+        上传在线程池中进行；调用线程作为唯一的调度器轮询所有未完成的订单，每个订单按各自的间隔查询。
+        返回与输入顺序一致的 {"text", "segments"} 列表，时间相对切片起点。
+        """
+        results = [None] * len(slices)
+        pending = {}  # orderId -> [切片序号, 下次查询时间, 当前间隔]
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            uploads = {pool.submit(self._upload_slice, audio_slice, stop_event): i for i, audio_slice in enumerate(slices)}
+            while uploads or pending:
+                if stop_event is not None and stop_event.is_set():
+                    raise KeyboardInterrupt("用户请求停止任务")
+                for future in [f for f in uploads if f.done()]:
+                    i = uploads.pop(future)
+                    content = future.result()
+                    interval = _first_interval(content.get("taskEstimateTime"))
+                    pending[content["orderId"]] = [i, time.monotonic() + interval, interval]
+                    print(f"第{i + 1}/{len(slices)}个音频已上传，订单号: {content['orderId']}")
+                for order_id, state in sorted(pending.items(), key=lambda item: item[1][1]):
+                    if state[1] > time.monotonic():
+                        break
+                    content = self.get_result(order_id, stop_event)["content"]
+                    status = content['orderInfo']['status']
+                    if status == STATUS_DONE:
+                        results[state[0]] = parse_order_result(content.get("orderResult"))
+                        del pending[order_id]
+                        print(f"第{state[0] + 1}/{len(slices)}个音频转写完成")
+                    elif status == STATUS_FAILED:
+                        raise RuntimeError(f"讯飞转写失败: 订单 {order_id} failType={content['orderInfo'].get('failType')}")
+                    else:
+                        state[2] = min(state[2] * 1.5, POLL_MAX_INTERVAL)
+                        state[1] = time.monotonic() + state[2]
+                # 睡到最早的订单该查询时为止；仍有上传进行中时缩短间隔以便及时登记新订单
+                next_poll = min((state[1] for state in pending.values()), default=time.monotonic() + 0.2)
+                time.sleep(min(max(next_poll - time.monotonic(), 0.05), 0.2 if uploads else 0.5))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        return results
+
+
+def _first_interval(estimate_ms):
+    """首次查询的等待时间：参考接口返回的预计处理时长（毫秒）"""
+    try:
+        seconds = float(estimate_ms or 0) / 1000
+    except (TypeError, ValueError):
+        seconds = 0
+    return min(max(seconds, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+
+
+def _sleep(seconds, stop_event=None):
+    if stop_event is None:
+        time.sleep(seconds)
+    elif stop_event.wait(seconds):
+        raise KeyboardInterrupt("用户请求停止任务")
+
+
+def parse_order_result(order_result):
+    """
+    将 orderResult（JSON 字符串或字典）解析为 {"text", "segments"}，
+    每个 segment 为一句话及其起止时间（秒，相对音频起点）。
+    """
+    if isinstance(order_result, str):
+        order_result = json.loads(order_result or "{}")
+    order_result = order_result or {}
+    segments = []
+    for lattice in order_result.get("lattice") or order_result.get("lattice2") or []:
+        json_1best = lattice.get("json_1best") or {}
+        if isinstance(json_1best, str):
+            json_1best = json.loads(json_1best)
+        st = json_1best.get("st", {})
+        text = ''.join(ws["cw"][0]["w"] for rt in st.get("rt", []) for ws in rt.get("ws", []) if ws.get("cw"))
+        if text:
+            segments.append({"start": int(st.get("bg", 0)) / 1000, "end": int(st.get("ed", 0)) / 1000, "text": text})
+    return {"text": ''.join(seg["text"] for seg in segments), "segments": segments}
+
 
 class RequestApi(object):
+    """单个文件的上传与查询（保留原有接口），内部使用 XunfeiClient"""
+
     def __init__(self, appid, secret_key, upload_file_path):
-        self.appid = appid
-        self.secret_key = secret_key
+        self.client = XunfeiClient(appid, secret_key)
         self.upload_file_path = upload_file_path
-        self.ts = str(int(time.time()))
-        self.signa = self.get_signa()
-
-    def get_signa(self):
-        appid = self.appid
-        secret_key = self.secret_key
-        m2 = hashlib.md5()
-        m2.update((appid + self.ts).encode('utf-8'))
-        md5 = m2.hexdigest()
-        md5 = bytes(md5, encoding='utf-8')
-        # 以secret_key为key, 上面的md5为msg， 使用hashlib.sha1加密结果为signa
-        signa = hmac.new(secret_key.encode('utf-8'), md5, hashlib.sha1).digest()
-        signa = base64.b64encode(signa)
-        signa = str(signa, 'utf-8')
-        return signa
-
 
     def upload(self):
         print("上传部分：")
-        upload_file_path = self.upload_file_path
-        file_len = os.path.getsize(upload_file_path)
-        file_name = os.path.basename(upload_file_path)
-
-        param_dict = {}
-        param_dict['appId'] = self.appid
-        param_dict['signa'] = self.signa
-        param_dict['ts'] = self.ts
-        param_dict["fileSize"] = file_len
-        param_dict["fileName"] = file_name
-        param_dict["duration"] = "200"
-        print("upload参数：", param_dict)
-        data = open(upload_file_path, 'rb').read(file_len)
-
-        response = requests.post(url =lfasr_host + api_upload+"?"+urllib.parse.urlencode(param_dict),
-                                headers = {"Content-type":"application/json"},data=data)
-        print("upload_url:",response.request.url)
-        result = json.loads(response.text)
+        result = self.client.upload(self.upload_file_path)
         print("upload resp:", result)
         return result
 
-
     def get_result(self):
         uploadresp = self.upload()
-        orderId = uploadresp['content']['orderId']
-        param_dict = {}
-        param_dict['appId'] = self.appid
-        param_dict['signa'] = self.signa
-        param_dict['ts'] = self.ts
-        param_dict['orderId'] = orderId
-        param_dict['resultType'] = "transfer,predict"
-        print("")
+        content = uploadresp['content']
         print("查询部分：")
-        print("get result参数：", param_dict)
-        status = 3
-        # 建议使用回调的方式查询结果，查询接口有请求频率限制
-        while status == 3:
-            response = requests.post(url=lfasr_host + api_get_result + "?" + urllib.parse.urlencode(param_dict),
-                                     headers={"Content-type": "application/json"})
-            # print("get_result_url:",response.request.url)
-            result = json.loads(response.text)
-            print(result)
-            status = result['content']['orderInfo']['status']
-            print("status=",status)
-            if status == 4:
-                break
-            time.sleep(5)
-        print("get_result resp:",result)
+        result = self.client.wait(content['orderId'], content.get('taskEstimateTime'))
+        print("get_result resp:", result)
         return result
 
 
-
-
-# 输入讯飞开放平台的appid，secret_key和待转写的文件路径
+# 讯飞开放平台的 appid 与 secret_key 通过 XUNFEI_APPID、XUNFEI_SECRET_KEY 配置
 def doRequest(folder, filename):
-    api = RequestApi(appid="1a1c1793",
-                     secret_key="***", # 请填写您自己的appid和KEY
+    api = RequestApi(appid=os.getenv("XUNFEI_APPID"),
+                     secret_key=os.getenv("XUNFEI_SECRET_KEY"),
                      upload_file_path=rf"audio/slice/{folder}/{filename}")
 
     res = api.get_result()
     print(res)
     return res
 
-import json
+
+def transcribe_slices(slices, stop_event=None):
+    """使用环境变量中的凭据并发转写切片，返回与 speech2text 相同结构的结果列表"""
+    return XunfeiClient().transcribe_slices(slices, stop_event=stop_event)
+
+
 def extract_and_format_transcription_from_string(json_string):
     """
-    This function takes a JSON string as input, parses it, 
+    This function takes a JSON string as input, parses it,
     extracts the transcription result, and formats it into a paragraph.
 
     :param json_string: JSON string containing response data
     :return: A string representing a formatted paragraph
     """
-    # Parse the JSON string
     json_data = json.loads(json_string)
-
-    # Extracting transcription result
-    order_result_str = json_data.get("content", {}).get("orderResult", "{}")
-    order_result = json.loads(order_result_str)
-
-    # Parsing the transcription result
-    sentences = []
-    for lattice in order_result.get("lattice", []):
-        json_1best_str = lattice.get("json_1best", "{}")
-        json_1best = json.loads(json_1best_str)
-        
-        # Extract and process each word
-        for rt in json_1best.get("st", {}).get("rt", []):
-            sentence = ''.join([cw[0]["w"] for ws in rt["ws"] for cw in ws["cw"]])
-            sentences.append(sentence)
-
+    order_result = json_data.get("content", {}).get("orderResult", "{}")
     # Joining sentences to form a paragraph
-    paragraph = ' '.join(sentences)
-    return paragraph
+    return ' '.join(seg["text"] for seg in parse_order_result(order_result)["segments"])